@@ -0,0 +1,75 @@
+"""
+Vectorized portfolio accounting: a portfolio is a pair of aligned arrays of
+security ids (positions in the price store) and share counts, valued against
+a row of prices aligned on the same ids.
+"""
+import numpy
+
+class Holdings(object):
+
+    def __init__(self, ids, shares):
+        order = numpy.argsort(ids)
+        self.ids = numpy.asarray(ids, dtype=numpy.int64)[order]
+        self.shares = numpy.asarray(shares, dtype=numpy.float64)[order]
+
+    @staticmethod
+    def empty():
+        return Holdings(numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))
+
+    def size(self):
+        return len(self.ids)
+
+    def amounts(self, prices):
+        return self.shares * prices
+
+    def valuation(self, prices):
+        return float(numpy.dot(self.shares, prices))
+
+    def aligned(self, previous):
+        """
+        Union of the ids of both portfolios with the shares of each, zero
+        where a portfolio does not hold the security.
+        """
+        ids = numpy.union1d(self.ids, previous.ids)
+        shares = numpy.zeros(len(ids))
+        previous_shares = numpy.zeros(len(ids))
+        shares[numpy.searchsorted(ids, self.ids)] = self.shares
+        previous_shares[numpy.searchsorted(ids, previous.ids)] = previous.shares
+        return ids, shares, previous_shares
+
+    def deltas(self, previous):
+        """
+        Masks of added, dropped and adjusted securities over the aligned ids,
+        with the shares traded.
+        """
+        ids, shares, previous_shares = self.aligned(previous)
+        held, previously_held = shares != 0, previous_shares != 0
+        added = held & ~previously_held
+        dropped = previously_held & ~held
+        adjusted = held & previously_held
+        return ids, added, dropped, adjusted, shares - previous_shares
+
+def turnover(shares, previous_shares, prices):
+    """
+    Amounts liquidated, newly invested and adjusted (in absolute value) when
+    moving from the previous shares to the shares, all aligned on prices.
+    """
+    held, previously_held = shares != 0, previous_shares != 0
+    dropped_amount = float(numpy.dot(previous_shares[previously_held & ~held], prices[previously_held & ~held]))
+    added_amount = float(numpy.dot(shares[held & ~previously_held], prices[held & ~previously_held]))
+    adjusted = held & previously_held
+    adjusted_amount = float(numpy.abs((shares[adjusted] - previous_shares[adjusted]) * prices[adjusted]).sum())
+    return dropped_amount, added_amount, adjusted_amount
+
+def transaction_costs(shares, previous_shares, prices, cost_rate, cost_per_share=0.0):
+    """
+    Proportional cost on the traded amount plus an optional cost per share.
+    """
+    traded = numpy.abs(shares - previous_shares)
+    return float(cost_rate * numpy.dot(traded, prices) + cost_per_share * traded.sum())
+
+def drawdowns(navs):
+    """
+    Relative decline of each NAV from the highest NAV reached so far.
+    """
+    return navs / numpy.maximum.accumulate(navs) - 1.0
@@ -0,0 +1,110 @@
+"""
+Results cache: an in-process LRU in front of a SQLite store in WAL mode, which
+concurrent readers and writers (e.g. parallel parameter sweeps) share safely.
+"""
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import logging
+from collections import OrderedDict
+
+def fingerprint(*parts):
+    """
+    Stable digest of the parts, used to tie cache keys to input contents.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class ResultCache(object):
+    """
+    Entries older than max_age seconds are ignored and purged, and the store
+    is trimmed to its max_entries most recently used entries.
+    """
+
+    def __init__(self, cache_name, max_entries=10000, max_age=30 * 24 * 3600, memory_entries=64):
+        self.__cache_name = cache_name
+        self.__max_entries = max_entries
+        self.__max_age = max_age
+        self.__memory_entries = memory_entries
+        self.__memory = OrderedDict()
+        self.__connection = None
+        self.__pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def __connect(self):
+        # connections must not be shared across forked processes
+        if self.__pid != os.getpid():
+            self.__connection = sqlite3.connect(self.__cache_name, timeout=60)
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)''')
+            self.__connection.commit()
+            self.__pid = os.getpid()
+
+        return self.__connection
+
+    def __remember(self, key, instance):
+        self.__memory.pop(key, None)
+        self.__memory[key] = instance
+        while len(self.__memory) > self.__memory_entries:
+            self.__memory.popitem(last=False)
+
+    def get(self, key, builder):
+        """
+        Cached instance for the key, built and stored on a miss.
+        """
+        if key in self.__memory:
+            instance = self.__memory.pop(key)
+            self.__memory[key] = instance
+            self.hits += 1
+            return instance
+
+        connection = self.__connect()
+        now = time.time()
+        row = connection.execute('SELECT value FROM results WHERE key = ? AND created >= ?', (key, now - self.__max_age)).fetchone()
+        if row is not None:
+            connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            connection.commit()
+            instance = pickle.loads(bytes(row[0]))
+            self.hits += 1
+
+        else:
+            instance = builder()
+            self.misses += 1
+            connection.execute('INSERT OR REPLACE INTO results (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                (key, sqlite3.Binary(pickle.dumps(instance, protocol=2)), now, now))
+            connection.commit()
+            self.trim()
+
+        self.__remember(key, instance)
+        return instance
+
+    def contains(self, key):
+        """
+        Whether an instance is cached for the key, without loading it.
+        """
+        if key in self.__memory:
+            return True
+
+        row = self.__connect().execute('SELECT 1 FROM results WHERE key = ? AND created >= ?', (key, time.time() - self.__max_age)).fetchone()
+        return row is not None
+
+    def trim(self):
+        connection = self.__connect()
+        connection.execute('DELETE FROM results WHERE created < ?', (time.time() - self.__max_age,))
+        connection.execute('''DELETE FROM results WHERE key NOT IN (
+            SELECT key FROM results ORDER BY accessed DESC LIMIT ?)''', (self.__max_entries,))
+        connection.commit()
+
+    def clear(self):
+        self.__memory.clear()
+        connection = self.__connect()
+        connection.execute('DELETE FROM results')
+        connection.commit()
+        logging.info('cleared cache %s' % self.__cache_name)
@@ -2,6 +2,7 @@ import os
 
 DATASOURCE_DIR = 'datasources'
 CACHE_DIR = 'cache.db'
+RESULTS_DIR = 'results'
 
 PRICES_DATA = os.sep.join((DATASOURCE_DIR, 'us-prices-adjusted-1992-2014.zip'))
 UNADJUSTED_PRICES_DATA = os.sep.join((DATASOURCE_DIR, 'us-prices-unadjusted-1992-2014.zip'))
@@ -11,6 +12,17 @@ SOURCE_US_FUNDS = os.sep.join((DATASOURCE_DIR, 'us-funds.csv'))
 SOURCE_DIVIDENDS = os.sep.join((DATASOURCE_DIR, 'dividends.csv'))
 SOURCE_BENCHMARK = os.sep.join((DATASOURCE_DIR, 'w5000.csv'))
 
-CACHE_PERFS = os.sep.join((CACHE_DIR, 'perf-data.db'))
+CACHE_PERFS = os.sep.join((CACHE_DIR, 'perf-data'))
 CACHE_VOLUMES = os.sep.join((CACHE_DIR, 'stats-volume.db'))
-CACHE_SCREENING = os.sep.join((CACHE_DIR, 'tmp-cache-screening.db'))
+CACHE_LIQUIDITY = os.sep.join((CACHE_DIR, 'liquidity-index.npz'))
+CACHE_SCREENING = os.sep.join((CACHE_DIR, 'cache-screening.sqlite'))
+CACHE_MANIFEST = os.sep.join((CACHE_DIR, 'ingest-manifest.json'))
+CACHE_BENCHMARK = os.sep.join((CACHE_DIR, 'benchmark.npz'))
+CACHE_DIVIDENDS = os.sep.join((CACHE_DIR, 'dividends-index.npz'))
+CACHE_UNIVERSE = os.sep.join((CACHE_DIR, 'universe-snapshots-%d.npz'))
+UNADJUSTED_PRICES_STORE = os.sep.join((CACHE_DIR, 'prices-unadjusted'))
+
+RESULTS_DB = os.sep.join((RESULTS_DIR, 'backtests.sqlite'))
+EQUITY_CURVE = os.sep.join((RESULTS_DIR, 'equity-curve.csv'))
+RUN_REPORT = os.sep.join((RESULTS_DIR, 'btrun-report.json'))
+RUN_PROFILE = os.sep.join((RESULTS_DIR, 'btrun.prof'))
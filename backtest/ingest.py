@@ -0,0 +1,363 @@
+"""
+Parallel, incremental ingest of the price ZIPs into the perfs and volume caches.
+
+Worker processes each open the ZIPs independently and stream disjoint sets of
+members, the parent process being the single writer of the caches. Daily
+returns (adjusted prices) and quarterly median dollar volumes (unadjusted
+prices) of a security are computed by the same task, in one pass.
+"""
+import os
+import json
+import time
+import logging
+from array import array
+from collections import defaultdict
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+from zipfile import ZipFile
+
+import numpy
+
+import constants
+from store import parse_day
+from perfs import PerfsStore
+from perfs import write_perfs_store
+
+QUARTERS = {
+    '01': ('01', '03'),
+    '02': ('01', '03'),
+    '03': ('01', '03'),
+    '04': ('04', '06'),
+    '05': ('04', '06'),
+    '06': ('04', '06'),
+    '07': ('07', '09'),
+    '08': ('07', '09'),
+    '09': ('07', '09'),
+    '10': ('10', '12'),
+    '11': ('10', '12'),
+    '12': ('10', '12'),
+}
+
+class InconsistentDateOrder(Exception):
+    pass
+
+def median(values):
+    """
+    Median by partial sort (selection) rather than a full sort.
+    """
+    length = len(values)
+    if not length % 2:
+        lower, upper = numpy.partition(values, (length // 2 - 1, length // 2))[length // 2 - 1:length // 2 + 1]
+        return (upper + lower) / 2.0
+    return numpy.partition(values, length // 2)[length // 2]
+
+def quarter_stats(volumes):
+    """
+    Median, mean and 20th percentile of the daily dollar volumes of a quarter,
+    with the number of days without any volume.
+    """
+    values = numpy.frombuffer(volumes, dtype=numpy.float64)
+    return int(median(values)), int(values.mean()), int(numpy.percentile(values, 20)), int((values == 0).sum())
+
+def security_code(dataset_name):
+    return dataset_name.split('/')[-1][:-4] # forward slash required by zip spec
+
+def dataset_name(code):
+    return 'output/' + code + '.txt'
+
+def quarter_start(yyyy_mm_dd):
+    return yyyy_mm_dd[:4] + QUARTERS[yyyy_mm_dd[5:7]][0]
+
+def security_performances(prices_file, since=None):
+    """
+    Daily returns between consecutive available closes, as (days, returns)
+    arrays, days being day numbers.
+
+    With since = (date, close) recorded by a previous run, only the returns
+    after that date are computed. Returns None as performances when the member
+    no longer has that close at that date, i.e. its history has been restated.
+    """
+    days, returns = list(), list()
+    count_rows = 0
+    price_prev = None
+    last = since
+    for row in prices_file:
+        count_rows += 1
+        if since is not None and row[:10] < since[0]:
+            continue
+
+        items = row.strip().split(',')
+        if items[4].startswith('#N/A'):
+            continue
+
+        px_last = float(items[4])
+        if since is not None and price_prev is None and (items[0], px_last) != since:
+            return None, None, count_rows
+
+        if price_prev is not None:
+            days.append(parse_day(items[0]))
+            returns.append((px_last / price_prev) - 1.0)
+
+        price_prev = px_last
+        last = (items[0], px_last)
+
+    if since is not None and price_prev is None:
+        return None, None, count_rows
+
+    return (numpy.array(days, dtype=numpy.int32), numpy.array(returns)), last, count_rows
+
+def security_volumes(prices_file, since=None):
+    """
+    Dollar volume stats per quarter, as (quarter_start, quarter_end, median,
+    mean, 20th percentile, days without volume).
+
+    Rows are streamed: only the volumes of the current quarter are kept, each
+    quarter being flushed once the dates move to the next one.
+
+    With since = (date, close) recorded by a previous run, only the quarters
+    from the one of that date onwards are computed, or None is returned as
+    stats when the member no longer matches.
+    """
+    stats = list()
+    quarter = None
+    volumes = array('d')
+    count_rows = 0
+    prev_date = '1970-01-01'
+    first_date = since[0][:5] + QUARTERS[since[0][5:7]][0] + '-01' if since else prev_date
+    matched = False
+    last = None
+    for row in prices_file:
+        count_rows += 1
+        if row[:10] <= prev_date:
+            raise InconsistentDateOrder('%s follows %s' % (row[:10], prev_date))
+
+        prev_date = row[:10]
+        if row[:10] < first_date:
+            continue
+
+        fields = row.strip().split(',')
+        if fields[-2].startswith('#N/A') or fields[-1].startswith('#N/A'):
+            continue
+
+        if since is not None and fields[0] == since[0]:
+            if float(fields[-2]) != since[1]:
+                return None, None, count_rows
+
+            matched = True
+
+        quarter_start_date, quarter_end_date = QUARTERS[fields[0][5:7]]
+        row_quarter = (fields[0][:4] + quarter_start_date, fields[0][:4] + quarter_end_date)
+        if row_quarter != quarter:
+            if quarter is not None:
+                stats.append(quarter + quarter_stats(volumes))
+
+            quarter, volumes = row_quarter, array('d')
+
+        volumes.append(float(fields[-1]) * float(fields[-2]))
+        last = (fields[0], float(fields[-2]))
+
+    if since is not None and not matched:
+        return None, None, count_rows
+
+    if quarter is not None:
+        stats.append(quarter + quarter_stats(volumes))
+
+    return stats, last, count_rows
+
+_sources = dict()
+
+def open_sources(sources):
+    """
+    Pool initializer: each worker opens its own handles on the ZIPs.
+    """
+    for name, source in sources.items():
+        _sources[name] = ZipFile(source, 'r')
+
+def process_member(name, code, since):
+    parse = security_performances if name == 'perfs' else security_volumes
+    with _sources[name].open(dataset_name(code)) as prices_file:
+        result, last, count_rows = parse(prices_file, since)
+
+    if result is None:
+        logging.info('history of %s changed in %s source, processing it again' % (code, name))
+        since = None
+        with _sources[name].open(dataset_name(code)) as prices_file:
+            result, last, count = parse(prices_file)
+            count_rows += count
+
+    return (result, last, since), count_rows
+
+def process_securities(tasks):
+    """
+    Processes a batch of (code, {source name: since}) tasks.
+    """
+    results = list()
+    for code, members in tasks:
+        outcomes = dict()
+        count_rows = 0
+        for name, since in members.items():
+            outcomes[name], count = process_member(name, code, since)
+            count_rows += count
+
+        results.append((code, outcomes, count_rows))
+
+    return results
+
+def load_manifest():
+    if not os.path.exists(constants.CACHE_MANIFEST):
+        return dict()
+
+    with open(constants.CACHE_MANIFEST, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(manifest):
+    with open(constants.CACHE_MANIFEST + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    os.rename(constants.CACHE_MANIFEST + '.tmp', constants.CACHE_MANIFEST)
+
+def list_members(source):
+    """
+    CRC32 and size of each member of the ZIP, by security code.
+    """
+    with ZipFile(source, 'r') as prices_zip:
+        return dict((security_code(info.filename), (info.CRC, info.file_size)) for info in prices_zip.infolist())
+
+def plan_tasks(sources, manifest):
+    """
+    Tasks for the new or changed members: members that only grew since the
+    previous run are resumed from the last date processed.
+    """
+    tasks = defaultdict(dict)
+    removed = dict()
+    for name, source in sources.items():
+        members = list_members(source)
+        previous = manifest.get(name, dict())
+        for code, (crc, size) in members.items():
+            entry = previous.get(code)
+            if entry is not None and (entry['crc'], entry['size']) == (crc, size):
+                continue
+
+            if entry is not None and entry.get('last') and size > entry['size']:
+                tasks[code][name] = tuple(entry['last'])
+
+            else:
+                tasks[code][name] = None
+
+        removed[name] = set(str(code) for code in previous.keys()) - set(members.keys())
+        manifest[name] = dict((code, previous[code]) for code in members if code in previous)
+        for code in tasks:
+            if name in tasks[code]:
+                manifest[name][code] = {'crc': members[code][0], 'size': members[code][1]}
+
+    return sorted(tasks.items()), removed
+
+def write_volumes(stats, removed, keep_previous):
+    """
+    Rewrites CACHE_VOLUMES: when keeping previous rows, those of the unchanged
+    securities and the quarters before the ones recomputed for the resumed
+    securities are preserved.
+    """
+    resumed = dict((code, quarter_start(since[0])) for code, (rows, since) in stats.items() if since is not None)
+    with open(constants.CACHE_VOLUMES + '.tmp', 'w') as stats_file:
+        if keep_previous and os.path.exists(constants.CACHE_VOLUMES):
+            with open(constants.CACHE_VOLUMES, 'r') as previous_file:
+                for row in previous_file:
+                    fields = row.strip().split(',')
+                    if len(fields) < 4 or fields[2] in removed:
+                        continue
+
+                    if fields[2] in stats and (fields[2] not in resumed or fields[0] >= resumed[fields[2]]):
+                        continue
+
+                    stats_file.write(row.strip())
+                    stats_file.write(os.linesep)
+
+        for code in sorted(stats.keys()):
+            for quarter in stats[code][0]:
+                stats_file.write(','.join(map(str, quarter[:2] + (code,) + quarter[2:])))
+                stats_file.write(os.linesep)
+
+    os.rename(constants.CACHE_VOLUMES + '.tmp', constants.CACHE_VOLUMES)
+
+def write_perfs(performances, removed, keep_previous):
+    """
+    Rewrites the CACHE_PERFS store: when keeping previous series, those of the
+    unchanged securities are preserved and those of the resumed securities
+    are extended.
+    """
+    series = dict()
+    if keep_previous and os.path.exists(os.sep.join((constants.CACHE_PERFS, 'codes.txt'))):
+        previous = PerfsStore(constants.CACHE_PERFS)
+        for code in previous.codes():
+            if code in removed or (code in performances and performances[code][1] is None):
+                continue
+
+            series[code] = previous.series(code)
+            if code in performances:
+                (days, returns), since = performances[code]
+                # returns after the resume date may already be stored by an interrupted run
+                kept = numpy.asarray(series[code][0]) <= parse_day(since[0])
+                series[code] = (numpy.concatenate((series[code][0][kept], days)), numpy.concatenate((series[code][1][kept], returns)))
+
+    for code, (result, since) in performances.items():
+        if code not in series:
+            series[code] = result
+
+    write_perfs_store(constants.CACHE_PERFS, series)
+    logging.info('stored %d returns for %d securities' % (sum(len(days) for days, _ in series.values()), len(series)))
+
+def chunks(values, size):
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+def build_stats(perfs=True, volumes=True, processes=None, batch_size=50, incremental=True):
+    """
+    Updates CACHE_PERFS and/or CACHE_VOLUMES from the price ZIPs.
+
+    A manifest keeps the CRC32 and size of every ZIP member along with the
+    last date processed: in incremental mode only the new or changed members
+    are processed again, from their last date when they only grew.
+    """
+    sources = dict()
+    if perfs:
+        sources['perfs'] = constants.PRICES_DATA
+
+    if volumes:
+        sources['volumes'] = constants.UNADJUSTED_PRICES_DATA
+
+    manifest = load_manifest() if incremental else dict()
+    tasks, removed = plan_tasks(sources, manifest)
+    logging.info('%d securities to process' % len(tasks))
+    performances = dict()
+    stats = dict()
+    pool = Pool(processes=processes or cpu_count(), initializer=open_sources, initargs=(sources,))
+    try:
+        start_time = time.time()
+        count_securities, count_rows = 0, 0
+        for results in pool.imap(process_securities, chunks(tasks, batch_size)):
+            for code, outcomes, count in results:
+                for name, (result, last, since) in outcomes.items():
+                    manifest[name][code]['last'] = last
+                    if name == 'volumes':
+                        stats[code] = (result, since)
+
+                    else:
+                        performances[code] = (result, since)
+
+                count_securities += 1
+                count_rows += count
+
+            elapsed = time.time() - start_time
+            logging.info('processed %d/%d securities, %d rows (%.0f rows/s)' % (count_securities, len(tasks), count_rows, count_rows / max(elapsed, 1e-6)))
+
+    finally:
+        pool.close()
+        pool.join()
+
+    if perfs:
+        write_perfs(performances, removed['perfs'], keep_previous=incremental)
+
+    if volumes:
+        write_volumes(stats, removed['volumes'], keep_previous=incremental)
+
+    save_manifest(manifest)
@@ -0,0 +1,165 @@
+"""
+Lightweight instrumentation: wall time and call counts of named stages, and
+counters such as cache hits and misses, recorded per period of a run.
+
+Profiling with cProfile, and memory tracing with tracemalloc where available
+(python 3), is opt-in.
+"""
+import json
+import time
+import cProfile
+import logging
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class Instrumentation(object):
+    
+    def __init__(self, period='setup'):
+        self.__period = period
+        self.__timings = OrderedDict()
+        self.__counters = OrderedDict()
+        self.__samples = dict()
+        
+    def start_period(self, period):
+        self.__period = period
+        
+    @contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+            
+        finally:
+            timing = self.__timings.setdefault((self.__period, name), [0, 0.0])
+            timing[0] += 1
+            timing[1] += time.time() - start_time
+            
+    def count(self, name, value=1):
+        key = (self.__period, name)
+        self.__counters[key] = self.__counters.get(key, 0) + value
+        
+    def sample_cache(self, name, hits, misses):
+        """
+        Counts the hits and misses of a cache since its previous sample, the
+        first sample only setting the baseline.
+        """
+        if name in self.__samples:
+            previous_hits, previous_misses = self.__samples[name]
+            self.count(name + ' hits', hits - previous_hits)
+            self.count(name + ' misses', misses - previous_misses)
+            
+        self.__samples[name] = (hits, misses)
+        
+    def periods(self):
+        """
+        Timings and counters of each period, in order of appearance.
+        """
+        periods = OrderedDict()
+        for (period, name), (calls, seconds) in self.__timings.items():
+            periods.setdefault(period, {'stages': dict(), 'counters': dict()})['stages'][name] = {'calls': calls, 'seconds': seconds}
+            
+        for (period, name), value in self.__counters.items():
+            periods.setdefault(period, {'stages': dict(), 'counters': dict()})['counters'][name] = value
+            
+        return periods
+        
+    def totals(self):
+        """
+        Returns (stages, counters) summed over all periods.
+        """
+        stages, counters = OrderedDict(), OrderedDict()
+        for (period, name), (calls, seconds) in self.__timings.items():
+            total = stages.setdefault(name, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+            
+        for (period, name), value in self.__counters.items():
+            counters[name] = counters.get(name, 0) + value
+            
+        return stages, counters
+        
+    def summary(self):
+        """
+        Lines of the per-run report: time and calls by stage, counters and
+        cache hit rates.
+        """
+        stages, counters = self.totals()
+        elapsed = sum(seconds for calls, seconds in stages.values())
+        lines = ['%-28s %8s %10s %6s' % ('stage', 'calls', 'seconds', '%')]
+        for name, (calls, seconds) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            lines.append('%-28s %8d %10.3f %6.1f' % (name, calls, seconds, 100.0 * seconds / max(elapsed, 1e-9)))
+            
+        for name, value in counters.items():
+            lines.append('%-28s %8d' % (name, value))
+            if name.endswith(' hits'):
+                misses = counters.get(name[:-len(' hits')] + ' misses', 0)
+                lines.append('%-28s %8.1f%%' % (name[:-len(' hits')] + ' hit rate', 100.0 * value / max(value + misses, 1)))
+                
+        return lines
+        
+    def save(self, report_path):
+        stages, counters = self.totals()
+        report = {
+            'periods': [dict(period=period, **values) for period, values in self.periods().items()],
+            'stages': dict((name, {'calls': calls, 'seconds': seconds}) for name, (calls, seconds) in stages.items()),
+            'counters': counters,
+            }
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+            
+class NullInstrumentation(Instrumentation):
+    """
+    Records nothing, for runs without instrumentation.
+    """
+    
+    def start_period(self, period):
+        pass
+        
+    @contextmanager
+    def stage(self, name):
+        yield
+        
+    def count(self, name, value=1):
+        pass
+        
+    def sample_cache(self, name, hits, misses):
+        pass
+            
+@contextmanager
+def profiling(profile_path=None, trace_memory=False, count_allocations=25):
+    """
+    Saves cProfile stats to profile_path when given, and logs the largest
+    allocations when tracing memory.
+    """
+    if trace_memory and tracemalloc is None:
+        logging.warning('tracemalloc is not available, memory is not traced')
+        
+    tracing = trace_memory and tracemalloc is not None
+    profiler = cProfile.Profile() if profile_path else None
+    if tracing:
+        tracemalloc.start()
+        
+    if profiler is not None:
+        profiler.enable()
+        
+    try:
+        yield
+        
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            logging.info('saved profile to %s' % profile_path)
+            
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            logging.info('traced memory: %d bytes, peak %d bytes' % (current, peak))
+            for statistic in snapshot.statistics('lineno')[:count_allocations]:
+                logging.info('%s' % statistic)
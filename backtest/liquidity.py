@@ -0,0 +1,97 @@
+"""
+Liquidity index: median dollar volume as a (quarters x securities) matrix,
+security codes being interned to integer ids (their rank in sorted order),
+along with matrices of the mean and 20th percentile dollar volumes and of the
+number of days without volume.
+
+Built from the CACHE_VOLUMES text file and saved as a binary sidecar which is
+rebuilt whenever the text file is newer.
+"""
+import os
+import logging
+
+import numpy
+
+import constants
+from store import is_fresh
+from store import save_arrays
+
+class LiquidityIndex(object):
+
+    FIELDS = ('volumes', 'means', 'lows', 'zero_days')
+
+    def __init__(self, quarters, codes, volumes, means, lows, zero_days):
+        self.quarters = quarters
+        self.codes = codes
+        self.volumes = volumes
+        self.means = means
+        self.lows = lows
+        self.zero_days = zero_days
+        self.__ids = dict((code, security_id) for security_id, code in enumerate(codes))
+
+    @staticmethod
+    def build(volumes_path):
+        rows = list()
+        with open(volumes_path, 'r') as liquidity_file:
+            for row in liquidity_file:
+                fields = row.strip().split(',')
+                if len(fields) >= 4:
+                    # rows without the extra stats only have the median
+                    rows.append((int(fields[0]), fields[2], map(int, fields[3:7]) + [0] * (7 - len(fields))))
+
+        quarters = numpy.array(sorted(set(quarter for quarter, _, _ in rows)), dtype=numpy.int32)
+        codes = sorted(set(code for _, code, _ in rows))
+        quarter_rows = dict((quarter, position) for position, quarter in enumerate(quarters.tolist()))
+        ids = dict((code, security_id) for security_id, code in enumerate(codes))
+        stats = numpy.zeros((len(LiquidityIndex.FIELDS), len(quarters), len(codes)), dtype=numpy.int64)
+        for quarter, code, values in rows:
+            stats[:, quarter_rows[quarter], ids[code]] = values
+
+        return LiquidityIndex(quarters, numpy.array(codes), *stats)
+
+    @staticmethod
+    def load(volumes_path=constants.CACHE_VOLUMES, index_path=constants.CACHE_LIQUIDITY):
+        if not is_fresh(index_path, volumes_path):
+            logging.info('building liquidity index from %s' % volumes_path)
+            index = LiquidityIndex.build(volumes_path)
+            index.save(index_path)
+            return index
+
+        with open(index_path, 'rb') as index_file:
+            arrays = numpy.load(index_file)
+            if all(field in arrays.files for field in LiquidityIndex.FIELDS):
+                return LiquidityIndex(arrays['quarters'], arrays['codes'], *[arrays[field] for field in LiquidityIndex.FIELDS])
+
+        # index saved before the extra stats were added
+        os.remove(index_path)
+        return LiquidityIndex.load(volumes_path, index_path)
+
+    def save(self, index_path):
+        save_arrays(index_path, quarters=self.quarters, codes=self.codes,
+            **dict((field, getattr(self, field)) for field in LiquidityIndex.FIELDS))
+
+    def size(self):
+        return len(self.codes)
+
+    def security_ids(self, codes):
+        return numpy.array([self.__ids[code] for code in codes if code in self.__ids], dtype=numpy.int64)
+
+    def mask(self, codes):
+        """
+        Boolean mask over security ids of the given codes.
+        """
+        selected = numpy.zeros(len(self.codes), dtype=bool)
+        selected[self.security_ids(codes)] = True
+        return selected
+
+    def liquid(self, quarter, min_dollar_volume):
+        """
+        Boolean mask of the securities traded over the quarter with a median
+        dollar volume of at least min_dollar_volume.
+        """
+        position = numpy.searchsorted(self.quarters, quarter)
+        if position == len(self.quarters) or self.quarters[position] != quarter:
+            return numpy.zeros(len(self.codes), dtype=bool)
+
+        volumes = self.volumes[position]
+        return (volumes > 0) & (volumes >= min_dollar_volume)
@@ -0,0 +1,100 @@
+"""
+Compact daily returns store, written by the ingest and opened via mmap:
+
+    codes.txt          security codes, in storage order
+    offsets.npy        int64 boundaries of each security within the blocks
+    calendar.npy       int32 day numbers of all the dates having a return
+    month-offsets.npy  int64 first calendar row of each month from the first
+                       one, followed by the number of rows
+    date-index.npy     int32 calendar row of each return
+    returns.npy        float32 daily returns between consecutive closes
+
+About 8 bytes per observation, against about 19 for the former shelve of
+per-security dicts keyed by 'YYYYMMDD', i.e. roughly 2.5 times smaller.
+"""
+import os
+
+import numpy
+
+from store import write_array
+
+def day_months(days):
+    """
+    Months elapsed since 1970-01 of day numbers.
+    """
+    return numpy.asarray(days).astype('datetime64[D]').astype('datetime64[M]').astype(numpy.int64)
+
+def write_perfs_store(store_dir, series):
+    """
+    Writes the (days, returns) series of each security code.
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    codes = sorted(series.keys())
+    offsets = numpy.zeros(len(codes) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(series[code][0]) for code in codes])
+    days = numpy.concatenate([numpy.zeros(0, dtype=numpy.int32)] + [numpy.asarray(series[code][0], dtype=numpy.int32) for code in codes])
+    returns = numpy.concatenate([numpy.zeros(0)] + [numpy.asarray(series[code][1]) for code in codes])
+    calendar = numpy.unique(days).astype(numpy.int32)
+    months = day_months(calendar)
+    month_offsets = numpy.searchsorted(months, numpy.arange(months[0], months[-1] + 2)) if len(months) else numpy.zeros(1)
+    write_array(store_dir, 'offsets', offsets)
+    write_array(store_dir, 'calendar', calendar)
+    write_array(store_dir, 'month-offsets', numpy.asarray(month_offsets, dtype=numpy.int64))
+    write_array(store_dir, 'date-index', numpy.searchsorted(calendar, days).astype(numpy.int32))
+    write_array(store_dir, 'returns', returns.astype(numpy.float32))
+    codes_path = os.sep.join((store_dir, 'codes.txt'))
+    with open(codes_path + '.tmp', 'w') as codes_file:
+        codes_file.write(os.linesep.join(codes))
+    os.rename(codes_path + '.tmp', codes_path)
+
+class PerfsStore(object):
+    """
+    Read-only view over a returns store, arrays being memory-mapped.
+    """
+
+    def __init__(self, store_dir):
+        self.__store_dir = store_dir
+        with open(os.sep.join((store_dir, 'codes.txt')), 'r') as codes_file:
+            self.__codes = [code.strip() for code in codes_file if len(code.strip()) != 0]
+
+        self.__index = dict((code, position) for position, code in enumerate(self.__codes))
+        self.__offsets = numpy.load(os.sep.join((store_dir, 'offsets.npy')), mmap_mode='r')
+        self.calendar = numpy.load(os.sep.join((store_dir, 'calendar.npy')), mmap_mode='r')
+        self.month_offsets = numpy.load(os.sep.join((store_dir, 'month-offsets.npy')), mmap_mode='r')
+        self.date_index = numpy.load(os.sep.join((store_dir, 'date-index.npy')), mmap_mode='r')
+        self.returns = numpy.load(os.sep.join((store_dir, 'returns.npy')), mmap_mode='r')
+
+    def codes(self):
+        return self.__codes
+
+    def version(self):
+        """
+        Changes whenever the store is rewritten.
+        """
+        stats = [os.stat(os.sep.join((self.__store_dir, name))) for name in ('codes.txt', 'offsets.npy', 'date-index.npy', 'returns.npy')]
+        return tuple((int(stat.st_mtime), stat.st_size) for stat in stats)
+
+    def size(self):
+        return len(self.__codes)
+
+    def first_month(self):
+        """
+        Month (since 1970-01) of the first calendar row.
+        """
+        return int(day_months(self.calendar[:1])[0]) if len(self.calendar) else 0
+
+    def owners(self):
+        """
+        Storage position of the security owning each return.
+        """
+        return numpy.repeat(numpy.arange(len(self.__codes)), numpy.diff(self.__offsets))
+
+    def series(self, code):
+        """
+        Returns (days, returns) of the security.
+        """
+        position = self.__index[code]
+        start, end = int(self.__offsets[position]), int(self.__offsets[position + 1])
+        return self.calendar[self.date_index[start:end]], self.returns[start:end]
@@ -1,56 +1,339 @@
-from zipfile import ZipFile
-from datetime import datetime
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy
+
 import constants
+from sources import shared
+from store import PriceStore
+from store import day_number
+from store import parse_day
+from store import parse_yyyymmdd
+from store import is_fresh
+from store import save_arrays
+from store import search_segments
 
-def find_latest_before(as_of_date, prices):
-    dates = prices.keys()
-    max_date = max([date for date in dates if date <= as_of_date])
-    return prices[max_date]
+def find_latest_before(as_of_date, dates, values):
+    """
+    As-of lookup by binary search over sorted dates (day numbers).
+    """
+    position = numpy.searchsorted(dates, day_number(as_of_date), side='right') - 1
+    if position < 0:
+        raise ValueError('no value available as of %s' % as_of_date.strftime('%Y-%m-%d'))
+        
+    return float(values[position])
 
-class Pricing(object):
+def load_benchmark(benchmark_path=constants.SOURCE_BENCHMARK, sidecar_path=constants.CACHE_BENCHMARK):
+    """
+    Returns the (dates, levels) arrays of the benchmark, from the binary
+    sidecar unless the CSV file is newer.
+    """
+    if is_fresh(sidecar_path, benchmark_path):
+        with open(sidecar_path, 'rb') as sidecar_file:
+            arrays = numpy.load(sidecar_file)
+            return arrays['dates'], arrays['levels']
+            
+    logging.info('parsing benchmark from %s' % benchmark_path)
+    with open(benchmark_path, 'r') as benchmark_file:
+        benchmark = dict()
+        for row in benchmark_file.readlines():
+            yyyymmdd, value = row.strip().split(',') 
+            benchmark[parse_day(yyyymmdd)] = float(value)
+            
+    dates = numpy.array(sorted(benchmark.keys()), dtype=numpy.int32)
+    levels = numpy.array([benchmark[day] for day in dates])
+    save_arrays(sidecar_path, dates=dates, levels=levels)
+    return dates, levels
     
-    def __init__(self):
-        self.__prices_zip = ZipFile(constants.UNADJUSTED_PRICES_DATA, 'r')
-        with open(constants.SOURCE_BENCHMARK, 'r') as benchmark_file:
-            self.__benchmark = dict()
-            for row in benchmark_file.readlines():
-                yyyymmdd, value = row.strip().split(',') 
-                self.__benchmark[datetime.strptime(yyyymmdd, '%Y-%m-%d')] = float(value)
-                            
-        with open(constants.SOURCE_DIVIDENDS, 'r') as dividends_file:
-            self.__dividends = dict()
+class DividendIndex(object):
+    """
+    Dividends of all securities as sorted per-security blocks of dates and
+    cumulative amounts: the total over a date range is two binary searches and
+    a subtraction.
+    
+    Built from the dividends CSV file and saved as a binary sidecar which is
+    rebuilt whenever the CSV file is newer.
+    """
+    
+    def __init__(self, codes, offsets, dates, cumulative):
+        self.codes = codes
+        self.offsets = offsets
+        self.dates = dates
+        self.cumulative = cumulative
+        self.__positions = dict((code, position) for position, code in enumerate(codes.tolist()))
+        
+    @staticmethod
+    def build(dividends):
+        codes = sorted(dividends.keys())
+        offsets = numpy.zeros(len(codes) + 1, dtype=numpy.int64)
+        dates, amounts = list(), list()
+        for position, code in enumerate(codes):
+            for day in sorted(dividends[code].keys()):
+                dates.append(day)
+                amounts.append(dividends[code][day])
+                
+            offsets[position + 1] = len(dates)
+            
+        return DividendIndex(numpy.array(codes), offsets, numpy.array(dates, dtype=numpy.int32), numpy.concatenate(([0.0], numpy.cumsum(amounts))))
+        
+    @staticmethod
+    def load(dividends_path=constants.SOURCE_DIVIDENDS, index_path=constants.CACHE_DIVIDENDS):
+        if is_fresh(index_path, dividends_path):
+            with open(index_path, 'rb') as index_file:
+                arrays = numpy.load(index_file)
+                return DividendIndex(arrays['codes'], arrays['offsets'], arrays['dates'], arrays['cumulative'])
+                
+        logging.info('building dividends index from %s' % dividends_path)
+        with open(dividends_path, 'r') as dividends_file:
+            dividends = dict()
             for row in dividends_file.readlines():
                 code, yyyymmdd, value = row.strip().split(',') 
-                if not self.__dividends.has_key(code):
-                    self.__dividends[code] = dict()
+                if not dividends.has_key(code):
+                    dividends[code] = dict()
                     
-                self.__dividends[code][datetime.strptime(yyyymmdd, '%Y%m%d')] = float(value)
-            
-        self.__prices = dict()
+                dividends[code][parse_yyyymmdd(yyyymmdd)] = float(value)
+                
+        index = DividendIndex.build(dividends)
+        save_arrays(index_path, codes=index.codes, offsets=index.offsets, dates=index.dates, cumulative=index.cumulative)
+        return index
         
-    def get_dividends(self, date_start, date_end, code):
-        if not self.__dividends.has_key(code):
-            return 0.0
+    def totals(self, date_start, date_end, codes):
+        """
+        Sum of the dividends paid within [date_start; date_end] for each code.
+        """
+        positions = [self.__positions.get(code, -1) for code in codes]
+        known = numpy.array([position >= 0 for position in positions], dtype=bool)
+        positions = numpy.array(positions, dtype=numpy.int64)[known]
+        starts, ends = self.offsets[positions], self.offsets[positions + 1]
+        first = search_segments(self.dates, starts, ends, day_number(date_start) - 1) + 1
+        last = search_segments(self.dates, starts, ends, day_number(date_end)) + 1
+        totals = numpy.zeros(len(codes))
+        totals[known] = self.cumulative[last] - self.cumulative[first]
+        return totals
+        
+    def running_totals(self, date_start, days, codes):
+        """
+        Sums of the dividends paid from date_start through each of the days
+        (day numbers), as a (days x codes) matrix.
+        """
+        positions = [self.__positions.get(code, -1) for code in codes]
+        known = numpy.array([position >= 0 for position in positions], dtype=bool)
+        positions = numpy.array(positions, dtype=numpy.int64)[known]
+        starts, ends = self.offsets[positions], self.offsets[positions + 1]
+        first = search_segments(self.dates, starts, ends, day_number(date_start) - 1) + 1
+        count_days = len(days)
+        last = search_segments(self.dates, numpy.tile(starts, count_days), numpy.tile(ends, count_days), numpy.repeat(days, len(starts))) + 1
+        totals = numpy.zeros((count_days, len(codes)))
+        totals[:, known] = self.cumulative[last.reshape(count_days, len(starts))] - self.cumulative[first]
+        return totals
+        
+class PriceBlocks(object):
+    """
+    Bounded LRU cache of dense (days x securities) as-of price blocks, the
+    least recently used blocks being evicted beyond max_bytes.
+    """
+    
+    def __init__(self, max_bytes):
+        self.__max_bytes = max_bytes
+        self.__blocks = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    def add(self, key, dates, columns, prices):
+        with self.__lock:
+            if key in self.__blocks:
+                return
+                
+            self.__blocks[key] = (dates, columns, prices)
+            self.__size += prices.nbytes
+            while self.__size > self.__max_bytes and len(self.__blocks) > 1:
+                evicted_key, (_, _, evicted) = self.__blocks.popitem(last=False)
+                self.__size -= evicted.nbytes
+                logging.debug('evicted price block %s' % (evicted_key[1:],))
+                
+    def find(self, day, codes):
+        """
+        Prices as of the day from a block covering the day and all the codes,
+        or None.
+        """
+        with self.__lock:
+            for key in reversed(self.__blocks.keys()):
+                dates, columns, prices = self.__blocks[key]
+                if dates[0] <= day <= key[2] and all(code in columns for code in codes):
+                    self.__blocks[key] = self.__blocks.pop(key)
+                    self.hits += 1
+                    row = numpy.searchsorted(dates, day, side='right') - 1
+                    return prices[row, [columns[code] for code in codes]]
+                    
+            self.misses += 1
+            return None
             
-        values = [self.__dividends[code][date]
-            for date in self.__dividends[code].keys()
-            if date >= date_start and date <= date_end]
+    def find_range(self, day_start, day_end, codes):
+        """
+        Returns (dates, prices) of the codes from a block loaded for exactly
+        this date range, or None.
+        """
+        with self.__lock:
+            for key in reversed(self.__blocks.keys()):
+                dates, columns, prices = self.__blocks[key]
+                if key[1:] == (day_start, day_end) and all(code in columns for code in codes):
+                    self.__blocks[key] = self.__blocks.pop(key)
+                    self.hits += 1
+                    return dates, prices[:, [columns[code] for code in codes]]
+                    
+            self.misses += 1
+            return None
             
-        return sum(values)
+    def size(self):
+        return self.__size
+        
+class Pricing(object):
+    """
+    Prices, dividends and benchmark are loaded on first use and shared with
+    the other Pricing instances of the process, each instance keeping its own
+    cache of price blocks.
+    """
+    
+    def __init__(self, cache_bytes=256 * 1024 * 1024):
+        self.__blocks = PriceBlocks(cache_bytes)
+        
+    @property
+    def __prices_store(self):
+        return shared(PriceStore, constants.UNADJUSTED_PRICES_STORE)
+        
+    @property
+    def __benchmark_dates(self):
+        return shared(load_benchmark, constants.SOURCE_BENCHMARK)[0]
+        
+    @property
+    def __benchmark_levels(self):
+        return shared(load_benchmark, constants.SOURCE_BENCHMARK)[1]
+        
+    @property
+    def __dividends(self):
+        return shared(DividendIndex.load, constants.SOURCE_DIVIDENDS)
+        
+    def load(self):
+        """
+        Loads all the data sources at once, e.g. before forking workers.
+        """
+        return self.__prices_store, self.__benchmark_dates, self.__dividends
+        
+    def security_ids(self, codes):
+        """
+        Security ids (positions in the price store) of the codes.
+        """
+        return numpy.array([self.__prices_store.position(code) for code in codes], dtype=numpy.int64)
+        
+    def security_codes(self, ids):
+        codes = self.__prices_store.codes()
+        return [codes[security_id] for security_id in ids]
+        
+    def get_dividends(self, date_start, date_end, code):
+        return float(self.__dividends.totals(date_start, date_end, [code])[0])
+        
+    def get_portfolio_dividends(self, date_start, date_end, codes):
+        """
+        Dividends per share paid within the period, for each of the codes.
+        """
+        return self.__dividends.totals(date_start, date_end, codes)
     
+    def get_running_dividends(self, date_start, days, codes):
+        """
+        Dividends per share paid from date_start through each of the days.
+        """
+        return self.__dividends.running_totals(date_start, days, codes)
+        
     def get_benchmark_level(self, date):
-        return find_latest_before(date, self.__benchmark)
+        return find_latest_before(date, self.__benchmark_dates, self.__benchmark_levels)
+        
+    def benchmark(self):
+        """
+        Returns the (dates, levels) arrays of the benchmark.
+        """
+        return self.__benchmark_dates, self.__benchmark_levels
+        
+    def get_benchmark_levels(self, days):
+        positions = numpy.searchsorted(self.__benchmark_dates, days, side='right') - 1
+        if (positions < 0).any():
+            raise ValueError('no benchmark level available as of day %d' % numpy.min(days))
+            
+        return self.__benchmark_levels[positions]
+    
+    def load_block(self, codes, date_range):
+        """
+        Dense as-of prices for the codes on the first day of the range and on
+        every trading day within it.
+        """
+        store = self.__prices_store
+        day_start, day_end = day_number(date_range[0]), day_number(date_range[1])
+        starts, ends = store.segments(codes)
+        series = list()
+        for start, end in zip(starts, ends):
+            dates = numpy.asarray(store.dates[start:end])
+            prices = numpy.asarray(store.close[start:end])
+            available = (dates <= day_end) & ~numpy.isnan(prices)
+            series.append((dates[available], prices[available]))
+            
+        trading_days = [dates[dates > day_start] for dates, _ in series]
+        block_dates = numpy.unique(numpy.concatenate([[day_start]] + trading_days)).astype(numpy.int32)
+        block = numpy.full((len(block_dates), len(codes)), numpy.nan)
+        for column, (dates, prices) in enumerate(series):
+            rows = numpy.searchsorted(dates, block_dates, side='right') - 1
+            block[rows >= 0, column] = prices[rows[rows >= 0]]
+            
+        columns = dict((code, column) for column, code in enumerate(codes))
+        self.__blocks.add((tuple(codes), day_start, day_end), block_dates, columns, block)
+        return block_dates, block
+        
+    def preload(self, codes, date_range):
+        """
+        Loads in the background the prices of the codes over the date range,
+        e.g. the next rebalance candidates while the current period is valued.
+        """
+        loader = threading.Thread(target=self.load_block, args=(list(codes), date_range))
+        loader.daemon = True
+        loader.start()
+        return loader
+        
+    def get_daily_prices(self, date_range, codes):
+        """
+        Returns (days, prices): as-of prices of the codes on the first day of
+        the range and on every trading day within it.
+        """
+        block = self.__blocks.find_range(day_number(date_range[0]), day_number(date_range[1]), codes)
+        if block is not None:
+            return block
+            
+        return self.load_block(codes, date_range)
+        
+    def cache_stats(self):
+        return self.__blocks.hits, self.__blocks.misses, self.__blocks.size()
+        
+    def get_prices(self, as_of_date, codes):
+        """
+        Latest available close as of the date for each of the codes, NaN where
+        the security has no price yet.
+        """
+        prices = self.__blocks.find(day_number(as_of_date), codes)
+        if prices is not None:
+            return prices
+            
+        store = self.__prices_store
+        starts, ends = store.segments(codes)
+        positions = search_segments(store.dates, starts, ends, day_number(as_of_date))
+        # #N/A closes resolve to the previous available one, saved at ingest
+        rows = numpy.where(positions >= starts, store.last_valid[numpy.maximum(positions, 0)], -1)
+        prices = numpy.full(len(positions), numpy.nan)
+        prices[rows >= 0] = store.close[rows[rows >= 0]]
+        return prices
     
     def get_price(self, as_of_date, code):
-        if not self.__prices.has_key(code):
-            self.__prices [code] = dict()
-            with self.__prices_zip.open('output/' + code + '.txt') as prices_file:
-                for row in prices_file.readlines():
-                    fields = row.strip().split(',')
-                    date = datetime.strptime(fields[0], '%Y-%m-%d')
-                    if not fields[-2].startswith('#N/A'):
-                        self.__prices[code] [date] = float(fields[-2])
-            
-        prices = self.__prices [code]
-        return find_latest_before(as_of_date, prices)
-        
\ No newline at end of file
+        price = self.get_prices(as_of_date, [code])[0]
+        if numpy.isnan(price):
+            raise ValueError('no price available for %s as of %s' % (code, as_of_date.strftime('%Y-%m-%d')))
+            
+        return float(price)
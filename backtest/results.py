@@ -0,0 +1,178 @@
+"""
+Results store: period returns, holdings, trades, cash and stage timings of
+every backtest run, in SQLite tables keyed by run id, each run recording its
+strategy and parameters.
+
+Backtests collect their rows in a RunRecorder, which is saved in one batch
+(and can be sent back from a worker process to a single writer).
+"""
+import json
+import time
+import uuid
+import sqlite3
+from collections import OrderedDict
+
+import numpy
+
+import constants
+
+TABLES = (
+    '''CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT PRIMARY KEY, batch_id TEXT, strategy TEXT, parameters TEXT, created REAL,
+        final_amount REAL, total_return REAL, benchmark_return REAL, elapsed REAL)''',
+    '''CREATE TABLE IF NOT EXISTS periods (
+        run_id TEXT, date_start TEXT, date_end TEXT, cash_start REAL, cash_end REAL,
+        valuation REAL, performance REAL, benchmark_performance REAL)''',
+    '''CREATE TABLE IF NOT EXISTS holdings (run_id TEXT, date TEXT, code TEXT, shares REAL, price REAL)''',
+    '''CREATE TABLE IF NOT EXISTS trades (run_id TEXT, date TEXT, code TEXT, shares REAL, price REAL)''',
+    '''CREATE TABLE IF NOT EXISTS timings (batch_id TEXT, period TEXT, stage TEXT, calls INTEGER, seconds REAL)''',
+    'CREATE INDEX IF NOT EXISTS periods_run ON periods (run_id)',
+    'CREATE INDEX IF NOT EXISTS holdings_run ON holdings (run_id, date)',
+    'CREATE INDEX IF NOT EXISTS trades_run ON trades (run_id, date)',
+    'CREATE INDEX IF NOT EXISTS timings_batch ON timings (batch_id)',
+    )
+
+class RunRecorder(object):
+    """
+    Rows of the runs of one batch, i.e. the strategies backtested together.
+    """
+
+    def __init__(self, parameters=None, batch_id=None):
+        self.batch_id = batch_id or '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+        self.parameters = dict(parameters or dict())
+        self.started = time.time()
+        self.elapsed = None
+        self.periods = OrderedDict()
+        self.holdings = list()
+        self.trades = list()
+        self.timings = list()
+
+    def run_id(self, strategy):
+        return '%s-%s' % (self.batch_id, strategy)
+
+    def add_period(self, strategy, date_start, date_end, cash_start, cash_end, valuation, performance, benchmark_performance):
+        self.periods.setdefault(strategy, list()).append((self.run_id(strategy), date_start.strftime('%Y-%m-%d'), date_end.strftime('%Y-%m-%d'),
+            cash_start, cash_end, valuation, performance, benchmark_performance))
+
+    def add_positions(self, strategy, date, codes, shares, prices, traded):
+        """
+        Records the holdings after a rebalance and the shares traded for it.
+        """
+        run_id, yyyy_mm_dd = self.run_id(strategy), date.strftime('%Y-%m-%d')
+        for code, count, price, trade in zip(codes, shares.tolist(), prices.tolist(), traded.tolist()):
+            if count != 0.0:
+                self.holdings.append((run_id, yyyy_mm_dd, code, count, price))
+
+            if trade != 0.0:
+                self.trades.append((run_id, yyyy_mm_dd, code, trade, price))
+
+    def add_timings(self, instruments):
+        for period, values in instruments.periods().items():
+            for stage, timing in values['stages'].items():
+                self.timings.append((self.batch_id, period, stage, timing['calls'], timing['seconds']))
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+
+class ResultsStore(object):
+
+    def __init__(self, results_db=constants.RESULTS_DB):
+        self.__connection = sqlite3.connect(results_db, timeout=60)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        for statement in TABLES:
+            self.__connection.execute(statement)
+
+        self.__connection.commit()
+
+    def close(self):
+        self.__connection.close()
+
+    def save(self, recorder):
+        """
+        Writes all the rows of the recorder in one transaction.
+        """
+        parameters = json.dumps(recorder.parameters, sort_keys=True)
+        runs = list()
+        for strategy, periods in recorder.periods.items():
+            # period rows end with valuation, performance and benchmark performance
+            amount_final = periods[-1][-3] if periods else None
+            total_return = float(numpy.prod([1.0 + period[-2] for period in periods]) - 1.0)
+            benchmark_return = float(numpy.prod([1.0 + period[-1] for period in periods]) - 1.0)
+            runs.append((recorder.run_id(strategy), recorder.batch_id, strategy, parameters, recorder.started,
+                amount_final, total_return, benchmark_return, recorder.elapsed))
+
+        with self.__connection:
+            self.__connection.executemany('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', runs)
+            self.__connection.executemany('INSERT INTO periods VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [row for periods in recorder.periods.values() for row in periods])
+            self.__connection.executemany('INSERT INTO holdings VALUES (?, ?, ?, ?, ?)', recorder.holdings)
+            self.__connection.executemany('INSERT INTO trades VALUES (?, ?, ?, ?, ?)', recorder.trades)
+            self.__connection.executemany('INSERT INTO timings VALUES (?, ?, ?, ?, ?)', recorder.timings)
+
+        return [run[0] for run in runs]
+
+    def runs(self, strategy=None, **parameters):
+        """
+        Runs of the strategy, if any, having all the given parameter values,
+        as dicts ordered by creation.
+        """
+        query = 'SELECT run_id, batch_id, strategy, parameters, created, final_amount, total_return, benchmark_return, elapsed FROM runs'
+        arguments = tuple()
+        if strategy is not None:
+            query += ' WHERE strategy = ?'
+            arguments = (strategy,)
+
+        columns = ('run_id', 'batch_id', 'strategy', 'parameters', 'created', 'final_amount', 'total_return', 'benchmark_return', 'elapsed')
+        runs = list()
+        for row in self.__connection.execute(query + ' ORDER BY created, run_id', arguments):
+            run = dict(zip(columns, row))
+            run['parameters'] = json.loads(run['parameters'])
+            if all(run['parameters'].get(name) == value for name, value in parameters.items()):
+                runs.append(run)
+
+        return runs
+
+    def periods(self, run_id):
+        """
+        Returns (date_start, date_end, cash_start, cash_end, valuation,
+        performance, benchmark_performance) for each period of the run.
+        """
+        return self.__connection.execute('''SELECT date_start, date_end, cash_start, cash_end, valuation, performance, benchmark_performance
+            FROM periods WHERE run_id = ? ORDER BY date_start''', (run_id,)).fetchall()
+
+    def holdings(self, run_id, date=None):
+        """
+        Returns (date, code, shares, price) of the holdings of the run, at the
+        given rebalance date only if any.
+        """
+        if date is None:
+            return self.__connection.execute('SELECT date, code, shares, price FROM holdings WHERE run_id = ? ORDER BY date, code', (run_id,)).fetchall()
+
+        return self.__connection.execute('SELECT date, code, shares, price FROM holdings WHERE run_id = ? AND date = ? ORDER BY code',
+            (run_id, date.strftime('%Y-%m-%d'))).fetchall()
+
+    def trades(self, run_id):
+        return self.__connection.execute('SELECT date, code, shares, price FROM trades WHERE run_id = ? ORDER BY date, code', (run_id,)).fetchall()
+
+    def timings(self, batch_id):
+        """
+        Returns (stage, calls, seconds) summed over the periods of the batch.
+        """
+        return self.__connection.execute('''SELECT stage, SUM(calls), SUM(seconds) FROM timings WHERE batch_id = ?
+            GROUP BY stage ORDER BY SUM(seconds) DESC''', (batch_id,)).fetchall()
+
+    def period_returns(self, run_ids):
+        """
+        Returns (dates, returns): the period start dates of all the runs and
+        a (dates x runs) matrix of their period returns, NaN where a run has
+        no such period.
+        """
+        placeholders = ', '.join('?' * len(run_ids))
+        rows = self.__connection.execute('SELECT run_id, date_start, performance FROM periods WHERE run_id IN (%s)' % placeholders, tuple(run_ids)).fetchall()
+        dates = sorted(set(date_start for _, date_start, _ in rows))
+        date_rows = dict((date_start, row) for row, date_start in enumerate(dates))
+        columns = dict((run_id, column) for column, run_id in enumerate(run_ids))
+        returns = numpy.full((len(dates), len(run_ids)), numpy.nan)
+        for run_id, date_start, performance in rows:
+            returns[date_rows[date_start], columns[run_id]] = performance
+
+        return dates, returns
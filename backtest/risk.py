@@ -0,0 +1,135 @@
+"""
+Risk engine over the daily returns matrix: betas against the benchmark for
+the whole universe and shrinkage covariance matrices for selected names, all
+estimated with vectorized linear algebra over a window of months.
+"""
+import numpy
+
+from screening import month_subtract
+
+class RiskModel(object):
+    """
+    Daily returns of the securities along with those of the benchmark, taken
+    as of each date of the returns matrix.
+
+    Both are loaded on first use from the returns_matrix and benchmark
+    functions, the latter returning the (dates, levels) of the benchmark, so
+    that backtests whose strategies need no risk estimates never load them.
+    """
+
+    def __init__(self, returns_matrix, benchmark):
+        self.__returns_matrix = returns_matrix
+        self.__benchmark = benchmark
+        self.__benchmark_returns = None
+
+    @property
+    def returns_matrix(self):
+        return self.__returns_matrix()
+
+    @property
+    def benchmark_returns(self):
+        if self.__benchmark_returns is None:
+            benchmark_dates, benchmark_levels = self.__benchmark()
+            positions = numpy.searchsorted(benchmark_dates, self.returns_matrix.dates, side='right') - 1
+            levels = numpy.where(positions >= 0, benchmark_levels[numpy.maximum(positions, 0)], numpy.nan)
+            self.__benchmark_returns = numpy.full(len(levels), numpy.nan)
+            self.__benchmark_returns[1:] = levels[1:] / levels[:-1] - 1.0
+
+        return self.__benchmark_returns
+
+    def window(self, yyyymm, count_months):
+        """
+        Estimates over the same window of months as the volatility screening.
+        """
+        return RiskWindow(self, month_subtract(yyyymm, count_months), yyyymm, count_months)
+
+class RiskWindow(object):
+
+    def __init__(self, model, start_yyyymm, end_yyyymm, count_months):
+        self.__model = model
+        self.__months = (start_yyyymm, end_yyyymm)
+        self.__min_count = 0.8 * (count_months * 20) # same data requirement as the volatilities
+        self.__betas = None
+
+    def __block(self, columns=None):
+        """
+        Returns for the window as float64 with the availability mask, days
+        without a benchmark return being left out.
+        """
+        rows = self.__model.returns_matrix.month_rows(*self.__months)
+        returns = self.__model.returns_matrix.returns[rows]
+        if columns is not None:
+            returns = returns[:, columns]
+
+        benchmark = self.__model.benchmark_returns[rows]
+        available = ~numpy.isnan(returns) & ~numpy.isnan(benchmark)[:, numpy.newaxis]
+        values = numpy.where(available, returns, 0.0).astype(numpy.float64)
+        return values, available, numpy.where(numpy.isnan(benchmark), 0.0, benchmark)
+
+    def betas(self, codes):
+        """
+        Beta of each of the codes against the benchmark, NaN when not enough
+        data. Betas of the whole universe are estimated at once on first use.
+        """
+        if self.__betas is None:
+            values, available, benchmark = self.__block()
+            mask = available.astype(numpy.float64)
+            counts = mask.sum(axis=0)
+            sums = values.sum(axis=0)
+            benchmark_sums = mask.T.dot(benchmark)
+            products = values.T.dot(benchmark)
+            benchmark_squares = mask.T.dot(benchmark ** 2)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                self.__betas = (counts * products - sums * benchmark_sums) / (counts * benchmark_squares - benchmark_sums ** 2)
+
+            self.__betas[counts <= self.__min_count] = numpy.nan # not enough data
+
+        columns = self.__model.returns_matrix.columns(codes)
+        return self.__betas[columns]
+
+    def covariance(self, codes, shrinkage=None):
+        """
+        Covariance matrix of daily returns of the codes, shrunk towards a
+        scaled identity with the Ledoit-Wolf intensity unless one is given.
+        Missing returns count as no deviation from the mean.
+        """
+        values, available, _ = self.__block(self.__model.returns_matrix.columns(codes))
+        counts = numpy.maximum(available.sum(axis=0), 1)
+        deviations = numpy.where(available, values - values.sum(axis=0) / counts, 0.0)
+        count_days, count_codes = deviations.shape
+        sample = deviations.T.dot(deviations) / count_days
+        target = numpy.trace(sample) / count_codes
+        if shrinkage is None:
+            dispersion = ((sample - target * numpy.eye(count_codes)) ** 2).sum() / count_codes
+            noise = (((deviations ** 2).sum(axis=1) ** 2).sum() / count_days - (sample ** 2).sum()) / (count_days * count_codes)
+            shrinkage = min(noise, dispersion) / dispersion if dispersion > 0.0 else 1.0
+
+        return shrinkage * target * numpy.eye(count_codes) + (1.0 - shrinkage) * sample
+
+def inverse_beta_weights(betas):
+    """
+    Weights proportional to the inverse of the betas, securities without a
+    positive beta being left out.
+    """
+    weights = numpy.zeros(len(betas))
+    positive = numpy.nan_to_num(betas) > 0.0
+    weights[positive] = 1.0 / betas[positive]
+    return weights / weights.sum() if weights.sum() > 0.0 else weights
+
+def minimum_variance_weights(covariance, long_only=True):
+    """
+    Fully invested minimum variance weights. When long only, securities
+    getting a negative weight are left out and the others solved again.
+    """
+    active = numpy.ones(len(covariance), dtype=bool)
+    while active.any():
+        inverses = numpy.linalg.solve(covariance[numpy.ix_(active, active)], numpy.ones(active.sum()))
+        solved = inverses / inverses.sum()
+        if not long_only or (solved >= 0.0).all():
+            break
+
+        active[numpy.flatnonzero(active)[solved < 0.0]] = False
+
+    weights = numpy.zeros(len(covariance))
+    weights[active] = solved
+    return weights
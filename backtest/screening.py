@@ -1,19 +1,12 @@
-import shelve
-import math
 import logging
-from datetime import datetime
 
-import constants
-
-def average(s):
-    return sum(s) * 1.0 / len(s)
+import numpy
 
-def variance(s):
-    avg = average(s)
-    return map(lambda x: (x - avg)**2, s)
-
-def stdev(s):
-    return math.sqrt(average(variance(s)))
+import constants
+from cache import ResultCache
+from cache import fingerprint
+from perfs import PerfsStore
+from sources import shared
 
 def month_subtract(yyyymm, n):
     start_yyyy = int(yyyymm[:4]) + int((int(yyyymm[-2:]) - n) / 12)
@@ -21,83 +14,241 @@ def month_subtract(yyyymm, n):
     start_yyyymm = '%d%02d' % (start_yyyy, start_mm)
     return start_yyyymm
 
-def compute_volatility(security_code, count_months, start_yyyymm, end_yyyymm):
-    performances = shelve.open(constants.CACHE_PERFS, 'r')
-    security_performances = [performances[security_code][date]
-            for date in performances[security_code].keys()
-            if date[:6] <= end_yyyymm
-            and date[:6] >= start_yyyymm
-        ]
-    performances.close()
-    if len(security_performances) <= 0.8 * (count_months * 20): return None # not enough data
-    
-    return stdev(security_performances)
+def month_number(yyyymm):
+    """
+    Months elapsed since 1970-01, as used by numpy datetime64[M].
+    """
+    return (int(yyyymm[:4]) - 1970) * 12 + int(yyyymm[-2:]) - 1
 
-def make_volatilities_statistics(universe, count_months, start_yyyymm, end_yyyymm):
-    volatilities = dict()
-    total = universe.size()
-    from multiprocessing import Pool
-    pool = Pool(processes=6) 
-    results = dict()
-    for index, security_code in enumerate(universe.securities()):
-        params = [security_code, count_months, start_yyyymm, end_yyyymm]
-        results[security_code] = pool.apply_async(compute_volatility, params)
-        #logging.debug('volatility for security %s (%d/%d) = %.2f%%' % (security_code, index + 1, total, volatility * 100.0))
-        #volatilities[security_code] = compute_volatility(security_code, performances, count_months, start_yyyymm, end_yyyymm)
-    
-    for security_code in results.keys():
-        result = results[security_code].get(timeout=30*60) # max 30 min
-        if result:
-            volatilities[security_code] = result
-    
+def masked_volatilities(block, count_months):
+    """
+    Population standard deviation of each column of a returns block, ignoring
+    NaN, or NaN where less than 80% of the expected observations are available.
+    """
+    available = ~numpy.isnan(block)
+    counts = available.sum(axis=0)
+    values = numpy.where(available, block, 0.0).astype(numpy.float64)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = values.sum(axis=0) / counts
+        deviations = numpy.where(available, values - means, 0.0)
+        volatilities = numpy.sqrt((deviations ** 2).sum(axis=0) / counts)
+
+    volatilities[counts <= 0.8 * (count_months * 20)] = numpy.nan # not enough data
+    return volatilities
+
+def aggregates_volatilities(counts, sums, squares, count_months):
+    """
+    Population standard deviation from running count, sum and sum of squares.
+    """
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        volatilities = numpy.sqrt(numpy.maximum(squares / counts - means ** 2, 0.0))
+        
+    volatilities[counts <= 0.8 * (count_months * 20)] = numpy.nan # not enough data
     return volatilities
 
-class SimpleCache(object):
+class RollingVolatility(object):
+    """
+    Keeps per security the running count, sum and sum of squares of the daily
+    returns over a window of months: moving the window forward by one month
+    adds the new month and drops the oldest one from the monthly aggregates,
+    only the months of the windows visited being aggregated.
+    """
     
-    def __init__(self, cache_name, builder_func, key_builder=str):
-        self.__kb = key_builder
-        self.__builder = builder_func
-        self.__cache_name = cache_name
-        
-    def get(self, *params):
-        cache = shelve.open(self.__cache_name, protocol=2)
-        if cache.has_key(self.__kb(*params)):
-            instance = cache[self.__kb(*params)]
+    def __init__(self, returns_matrix, count_months):
+        self.__returns = returns_matrix
+        self.__count_months = count_months
+        self.__window = None
+        
+    def move_to(self, start_yyyymm, end_yyyymm):
+        start, end = month_number(start_yyyymm), month_number(end_yyyymm)
+        if self.__window == (start - 1, end - 1):
+            added, dropped = self.__returns.month_aggregates(end), self.__returns.month_aggregates(start - 1)
+            self.__running = [total + added[index] - dropped[index] for index, total in enumerate(self.__running)]
             
         else:
-            instance = self.__builder()
-            cache[self.__kb(*params)] = instance
+            months = [self.__returns.month_aggregates(month) for month in range(start, end + 1)]
+            self.__running = [numpy.array([aggregates[index] for aggregates in months]).sum(axis=0) for index in range(3)]
             
-        cache.close()
+        self.__window = (start, end)
+        counts, sums, squares = self.__running
+        return aggregates_volatilities(counts, sums, squares, self.__count_months)
         
-        return instance
+class ReturnsMatrix(object):
+    """
+    Dense (dates x securities) matrix of daily returns between consecutive
+    available closes, NaN where the security has no data, scattered from the
+    returns store. The first row of every month is known from the store, so
+    that any window of months is a direct slice.
+    """
+    
+    def __init__(self, perfs_store):
+        codes = perfs_store.codes()
+        self.__codes = codes
+        self.version = perfs_store.version()
+        self.__columns = dict((code, column) for column, code in enumerate(codes))
+        self.dates = numpy.asarray(perfs_store.calendar)
+        self.__first_month = perfs_store.first_month()
+        self.__month_offsets = numpy.asarray(perfs_store.month_offsets)
+        self.returns = numpy.full((len(self.dates), len(codes)), numpy.nan, dtype=numpy.float32)
+        self.__aggregates = dict()
+        
+        self.returns[perfs_store.date_index, perfs_store.owners()] = perfs_store.returns
+        logging.info('loaded %d daily returns for %d securities' % (len(perfs_store.returns), len(codes)))
+        
+    def codes(self):
+        return self.__codes
+        
+    def columns(self, codes):
+        return numpy.array([self.__columns[code] for code in codes if code in self.__columns], dtype=numpy.int64)
+        
+    def month_rows(self, start_yyyymm, end_yyyymm):
+        """
+        Rows covering the months [start_yyyymm; end_yyyymm] as a slice.
+        """
+        count_months = len(self.__month_offsets) - 1
+        start = min(max(month_number(start_yyyymm) - self.__first_month, 0), count_months)
+        end = min(max(month_number(end_yyyymm) - self.__first_month + 1, 0), count_months)
+        return slice(int(self.__month_offsets[start]), int(self.__month_offsets[max(start, end)]))
+        
+    def volatilities(self, start_yyyymm, end_yyyymm, count_months):
+        """
+        Volatility of every security over the window, NaN when not enough data.
+        """
+        return masked_volatilities(self.returns[self.month_rows(start_yyyymm, end_yyyymm)], count_months)
+        
+    def month_aggregates(self, month):
+        """
+        Per security: count, sum and sum of squares of the returns over the
+        month (months since 1970-01), computed on first use.
+        """
+        if month not in self.__aggregates:
+            index = month - self.__first_month
+            if 0 <= index < len(self.__month_offsets) - 1:
+                block = self.returns[int(self.__month_offsets[index]):int(self.__month_offsets[index + 1])]
+                
+            else:
+                block = self.returns[:0]
+                
+            available = ~numpy.isnan(block)
+            values = numpy.where(available, block, 0.0).astype(numpy.float64)
+            self.__aggregates[month] = (available.sum(axis=0).astype(numpy.int64), values.sum(axis=0), (values ** 2).sum(axis=0))
+            
+        return self.__aggregates[month]
         
+    def volatilities_panel(self, end_yyyymms, count_months, incremental=True):
+        """
+        (windows x securities) volatilities for several rebalances at once.
+        """
+        panel = numpy.empty((len(end_yyyymms), len(self.__codes)))
+        rolling = RollingVolatility(self, count_months) if incremental else None
+        for row, end_yyyymm in enumerate(end_yyyymms):
+            start_yyyymm = month_subtract(end_yyyymm, count_months)
+            if rolling:
+                panel[row] = rolling.move_to(start_yyyymm, end_yyyymm)
+                
+            else:
+                panel[row] = self.volatilities(start_yyyymm, end_yyyymm, count_months)
+                
+        return panel
+    
+def load_returns_matrix(perfs_dir):
+    return ReturnsMatrix(shared(PerfsStore, perfs_dir))
+    
 class Screening(object):
+    """
+    The returns matrix is loaded on first use and shared with the other
+    Screening instances of the process.
+    """
     
-    def __init__(self, universe):
-        self.__performances = shelve.open(constants.CACHE_PERFS, 'r')
+    def __init__(self, universe, incremental=True):
         self.__universe = universe
+        self.__incremental = incremental
+        self.__panels = dict()
+        self.__rolling = dict()
+        self.__cache = ResultCache(constants.CACHE_SCREENING)
+        
+    @property
+    def __returns(self):
+        return shared(load_returns_matrix, constants.CACHE_PERFS)
+        
+    def prepare(self, yyyymms, count_months, min_dollar_volume=None):
+        """
+        Screens all the rebalance months in one go. Given the liquidity
+        threshold of the universe, months whose screening is already in the
+        results cache are skipped.
+        """
+        yyyymms = [yyyymm for yyyymm in yyyymms if (yyyymm, count_months) not in self.__panels]
+        if min_dollar_volume is not None:
+            snapshots = self.__universe.load_snapshots(min_dollar_volume)
+            # the universe screened over yyyymm is the one of the following month
+            months = [month_number(yyyymm) + 1 for yyyymm in yyyymms]
+            yyyymms = [yyyymm for yyyymm, month in zip(yyyymms, months) if not self.__cache.contains(
+                self.__key(yyyymm, count_months, snapshots.securities(1970 + month // 12, month % 12 + 1)))]
+            
+        if not yyyymms:
+            return
+            
+        panel = self.__returns.volatilities_panel(yyyymms, count_months, incremental=self.__incremental)
+        for yyyymm, volatilities in zip(yyyymms, panel):
+            self.__panels[(yyyymm, count_months)] = volatilities
+        
+    def make_volatilities_statistics(self, yyyymm, count_months):
+        if (yyyymm, count_months) in self.__panels:
+            volatilities = self.__panels[(yyyymm, count_months)]
+            
+        elif self.__incremental:
+            if count_months not in self.__rolling:
+                self.__rolling[count_months] = RollingVolatility(self.__returns, count_months)
+                
+            volatilities = self.__rolling[count_months].move_to(month_subtract(yyyymm, count_months), yyyymm)
+            
+        else:
+            volatilities = self.__returns.volatilities(month_subtract(yyyymm, count_months), yyyymm, count_months)
+            
+        codes = self.__returns.codes()
+        columns = self.__returns.columns(self.__universe.securities())
+        return dict((codes[column], float(volatilities[column])) for column in columns if not numpy.isnan(volatilities[column]))
+        
+    def __key(self, yyyymm, count_months, securities):
+        # stale results are never reused: key covers universe contents and data version
+        return fingerprint('volatilities', yyyymm, count_months, sorted(securities), shared(PerfsStore, constants.CACHE_PERFS).version())
+        
+    def cache_stats(self):
+        return self.__cache.hits, self.__cache.misses
+        
+    def returns_matrix(self):
+        return self.__returns
         
     def compute_volatilities(self, yyyymm, count_months, count_securities):
         """
-        @TODO: cache results
+        Returns the (lowest, highest) volatility securities.
+        """
+        lowest_volatility, highest_volatility, volatilities = self.screen(yyyymm, count_months, count_securities)
+        return (lowest_volatility, highest_volatility)
+        
+    def screen(self, yyyymm, count_months, count_securities):
+        """
+        Returns the lowest and highest volatility securities, along with the
+        volatility of every security of the universe having enough data.
         """
         end_yyyymm = yyyymm
         start_yyyymm = month_subtract(yyyymm, count_months)
         logging.info('considering volatility over [%s; %s]' % (start_yyyymm, end_yyyymm))
         volatilities = dict()
         
-        def stats_builder(universe=self.__universe, cm=count_months, sm=start_yyyymm, em=end_yyyymm):
-            return make_volatilities_statistics(universe, cm, sm, em)
+        def stats_builder(ym=yyyymm, cm=count_months):
+            return self.make_volatilities_statistics(ym, cm)
         
-        cache = SimpleCache(constants.CACHE_SCREENING, stats_builder, key_builder=lambda a, b: str((a, b)))
-        volatilities = cache.get(yyyymm, count_months)
+        volatilities = self.__cache.get(self.__key(yyyymm, count_months, self.__universe.securities()), stats_builder)
         
         logging.info('computed volatility for %d securities' % len(volatilities.keys()))
         
         lowest_volatility = sorted(volatilities, key=volatilities.get)[:count_securities]
         highest_volatility = sorted(volatilities, key=volatilities.get)[-count_securities:]
-        logging.debug('lowest volatility: %s' % ([(s, '%.02f%%' % (100.0 * volatilities[s])) for s in lowest_volatility]))
-        logging.debug('highest volatility: %s' % ([(s, '%.02f%%' % (100.0 * volatilities[s])) for s in highest_volatility]))
-        return (lowest_volatility, highest_volatility)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('lowest volatility: %s' % ([(s, '%.02f%%' % (100.0 * volatilities[s])) for s in lowest_volatility]))
+            logging.debug('highest volatility: %s' % ([(s, '%.02f%%' % (100.0 * volatilities[s])) for s in highest_volatility]))
+            
+        return lowest_volatility, highest_volatility, volatilities
         
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""
+Point-in-time universe snapshots: for every month, the securities eligible at
+the rebalance date (first day of the month) for a liquidity threshold, stored
+as one bitmap per month over the security ids of the liquidity index.
+
+A security is eligible for a month when it belongs to the preinitialized
+universe, traded with a median dollar volume of at least the threshold over
+the quarter of the month three months before, and has a close available as of
+the rebalance date.
+"""
+import os
+import logging
+from datetime import date
+
+import numpy
+
+import constants
+from cache import fingerprint
+from liquidity import LiquidityIndex
+from store import PriceStore
+from store import day_number
+from store import is_fresh
+from store import save_arrays
+
+# months covered when there is no liquidity data
+FIRST_MONTH = (1992, 1)
+LAST_MONTH = (2014, 12)
+
+def month_index(year, month):
+    """
+    Months elapsed since 1970-01.
+    """
+    return (year - 1970) * 12 + month - 1
+
+def rebalance_day(month):
+    return day_number(date(1970 + month // 12, month % 12 + 1, 1))
+
+def selection_quarter(month):
+    """
+    Quarter the liquidity of the month is measured over, as YYYYMM of its first
+    month: the quarter of the month three months before.
+    """
+    previous = month - 3
+    return (1970 + previous // 12) * 100 + (previous % 12) // 3 * 3 + 1
+
+def first_price_days(store, codes):
+    """
+    Day number of the first available close of each code, or the largest day
+    number when the store has none.
+    """
+    valid = numpy.flatnonzero(~numpy.isnan(store.close))
+    owners, first = numpy.unique(store.owners()[valid], return_index=True)
+    store_days = numpy.full(store.size(), numpy.iinfo(numpy.int32).max, dtype=numpy.int64)
+    store_days[owners] = store.dates[valid[first]]
+    days = numpy.full(len(codes), numpy.iinfo(numpy.int32).max, dtype=numpy.int64)
+    for security_id, code in enumerate(codes):
+        if store.has_security(code):
+            days[security_id] = store_days[store.position(code)]
+
+    return days
+
+def snapshots_path(min_dollar_volume):
+    return constants.CACHE_UNIVERSE % int(min_dollar_volume)
+
+class UniverseSnapshots(object):
+
+    def __init__(self, months, codes, bitmaps, securities_key):
+        self.months = months
+        self.codes = codes
+        self.bitmaps = bitmaps
+        self.securities_key = securities_key
+
+    @staticmethod
+    def build(securities, min_dollar_volume, first_month=None, last_month=None):
+        """
+        Snapshots of the months selected from the quarters of the liquidity
+        data, i.e. three to five months after each quarter starts, unless
+        the first and last months are given as (year, month).
+        """
+        liquidity = LiquidityIndex.load()
+        eligible = liquidity.mask(securities)
+        priced_from = first_price_days(PriceStore(constants.UNADJUSTED_PRICES_STORE), liquidity.codes)
+        quarters = [month_index(quarter // 100, quarter % 100) for quarter in liquidity.quarters.tolist()]
+        first = month_index(*first_month) if first_month else (quarters[0] + 3 if quarters else month_index(*FIRST_MONTH))
+        last = month_index(*last_month) if last_month else (quarters[-1] + 5 if quarters else month_index(*LAST_MONTH))
+        months = numpy.arange(first, last + 1, dtype=numpy.int32)
+        bitmaps = numpy.zeros((len(months), (liquidity.size() + 7) // 8), dtype=numpy.uint8)
+        for row, month in enumerate(months):
+            selected = eligible & liquidity.liquid(selection_quarter(month), min_dollar_volume)
+            bitmaps[row] = numpy.packbits(selected & (priced_from <= rebalance_day(month)))
+
+        logging.info('built universe snapshots of %d months for a liquidity of %.0f' % (len(months), min_dollar_volume))
+        return UniverseSnapshots(months, liquidity.codes, bitmaps, fingerprint(sorted(securities)))
+
+    @staticmethod
+    def load(securities, min_dollar_volume):
+        """
+        Snapshots saved for the threshold, rebuilt when the liquidity or price
+        data are newer or the preinitialized universe has changed.
+        """
+        path = snapshots_path(min_dollar_volume)
+        sources = (constants.CACHE_VOLUMES, os.sep.join((constants.UNADJUSTED_PRICES_STORE, 'close.npy')))
+        if is_fresh(path, *sources):
+            with open(path, 'rb') as snapshots_file:
+                arrays = numpy.load(snapshots_file)
+                snapshots = UniverseSnapshots(arrays['months'], arrays['codes'], arrays['bitmaps'], str(arrays['securities_key']))
+
+            if snapshots.securities_key == fingerprint(sorted(securities)):
+                return snapshots
+
+        snapshots = UniverseSnapshots.build(securities, min_dollar_volume)
+        snapshots.save(path)
+        return snapshots
+
+    def save(self, path):
+        save_arrays(path, months=self.months, codes=self.codes, bitmaps=self.bitmaps, securities_key=self.securities_key)
+
+    def securities(self, year, month):
+        """
+        Codes of the securities eligible as of the first day of the month.
+        """
+        row = month_index(year, month) - int(self.months[0])
+        if row < 0 or row >= len(self.months):
+            raise ValueError('no universe snapshot for month %d-%02d' % (year, month))
+
+        selected = numpy.unpackbits(self.bitmaps[row])[:len(self.codes)].astype(bool)
+        return self.codes[selected].tolist()
@@ -0,0 +1,28 @@
+"""
+Data sources loaded on first use and shared by all the consumers of a process,
+worker processes forked afterwards inheriting them.
+
+A source is loaded from a path and reloaded once the path is modified, e.g.
+when a store is rebuilt.
+"""
+import os
+import threading
+
+_sources = dict()
+_lock = threading.RLock()
+
+def shared(loader, path):
+    """
+    Result of loader(path), loaded once per modification of the path.
+    """
+    modified = os.path.getmtime(path)
+    with _lock:
+        loaded = _sources.get((loader, path))
+        if loaded is None or loaded[0] != modified:
+            _sources[(loader, path)] = (modified, loader(path))
+
+        return _sources[(loader, path)][1]
+
+def clear():
+    with _lock:
+        _sources.clear()
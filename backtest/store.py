@@ -0,0 +1,206 @@
+"""
+Columnar price store.
+
+A prices ZIP is converted once into a directory of flat arrays, one contiguous
+block per field, which are then opened via mmap:
+
+    codes.txt    security codes, in storage order
+    offsets.npy  int64 boundaries of each security within the field blocks
+    dates.npy    int32 day numbers (days since 1970-01-01)
+    close.npy    float64 close prices, NaN where the source has #N/A
+    volume.npy   float64 volumes, NaN where the source has #N/A
+    last-valid.npy  int64 row of the last available close at or before each
+                 row of the same security, -1 where there is none yet
+"""
+import os
+import logging
+from array import array
+from datetime import date
+from zipfile import ZipFile
+
+import numpy
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+def day_number(as_of_date):
+    return as_of_date.toordinal() - EPOCH
+
+def from_day_number(day):
+    return date.fromordinal(int(day) + EPOCH)
+
+def parse_day(yyyy_mm_dd):
+    """
+    Fixed-width parsing of 'YYYY-MM-DD', much cheaper than strptime.
+    """
+    return date(int(yyyy_mm_dd[:4]), int(yyyy_mm_dd[5:7]), int(yyyy_mm_dd[8:10])).toordinal() - EPOCH
+
+def parse_yyyymmdd(yyyymmdd):
+    """
+    Fixed-width parsing of 'YYYYMMDD'.
+    """
+    return date(int(yyyymmdd[:4]), int(yyyymmdd[4:6]), int(yyyymmdd[6:8])).toordinal() - EPOCH
+
+def parse_value(field):
+    if field.startswith('#N/A'):
+        return float('nan')
+    return float(field)
+
+def write_array(store_dir, name, values):
+    path = os.sep.join((store_dir, name + '.npy'))
+    with open(path + '.tmp', 'wb') as array_file:
+        numpy.save(array_file, values)
+    os.rename(path + '.tmp', path)
+
+def is_fresh(path, *sources):
+    """
+    Whether the file exists and is at least as recent as all the sources.
+    """
+    return os.path.exists(path) and all(os.path.getmtime(path) >= os.path.getmtime(source) for source in sources)
+
+def save_arrays(path, **arrays):
+    """
+    Saves the arrays as a npz file, replaced atomically.
+    """
+    with open(path + '.tmp', 'wb') as arrays_file:
+        numpy.savez(arrays_file, **arrays)
+    os.rename(path + '.tmp', path)
+
+def last_valid_rows(offsets, close):
+    """
+    Row of the last available close at or before each row, within the rows of
+    the same security, or -1.
+    """
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    close = numpy.asarray(close, dtype=numpy.float64)
+    rows = numpy.where(numpy.isnan(close), -1, numpy.arange(len(close), dtype=numpy.int64))
+    if len(rows) > 0:
+        rows = numpy.maximum.accumulate(rows)
+    rows[rows < numpy.repeat(offsets[:-1], numpy.diff(offsets))] = -1
+    return rows
+
+def write_price_store(store_dir, codes, offsets, dates, close, volume):
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    write_array(store_dir, 'offsets', numpy.asarray(offsets, dtype=numpy.int64))
+    write_array(store_dir, 'dates', numpy.asarray(dates, dtype=numpy.int32))
+    write_array(store_dir, 'close', numpy.asarray(close, dtype=numpy.float64))
+    write_array(store_dir, 'volume', numpy.asarray(volume, dtype=numpy.float64))
+    write_array(store_dir, 'last-valid', last_valid_rows(offsets, close))
+    codes_path = os.sep.join((store_dir, 'codes.txt'))
+    with open(codes_path + '.tmp', 'w') as codes_file:
+        codes_file.write(os.linesep.join(codes))
+    os.rename(codes_path + '.tmp', codes_path)
+
+def build_price_store(zip_path, store_dir):
+    codes = list()
+    offsets = [0]
+    dates = array('i')
+    close = array('d')
+    volume = array('d')
+    with ZipFile(zip_path, 'r') as prices_zip:
+        data_files = prices_zip.namelist()
+        for index, dataset_name in enumerate(data_files):
+            if index % 100 == 0:
+                logging.info('processing batch %d/%d' % (index / 100 + 1, len(data_files) / 100 + 1))
+
+            with prices_zip.open(dataset_name) as prices_file:
+                for row in prices_file:
+                    fields = row.strip().split(',')
+                    if len(fields) < 3: continue
+                    dates.append(parse_day(fields[0]))
+                    close.append(parse_value(fields[-2]))
+                    volume.append(parse_value(fields[-1]))
+
+            codes.append(dataset_name.split('/')[-1][:-4]) # forward slash required by zip spec
+            offsets.append(len(dates))
+
+    write_price_store(store_dir, codes, offsets, dates, close, volume)
+    logging.info('stored %d rows for %d securities in %s' % (len(dates), len(codes), store_dir))
+
+class PriceStore(object):
+    """
+    Read-only, zero-copy view over a price store: arrays are memory-mapped so
+    that worker processes share the same pages.
+    """
+
+    def __init__(self, store_dir):
+        self.__store_dir = store_dir
+        with open(os.sep.join((store_dir, 'codes.txt')), 'r') as codes_file:
+            self.__codes = [code.strip() for code in codes_file if len(code.strip()) != 0]
+
+        self.__index = dict((code, position) for position, code in enumerate(self.__codes))
+        self.__offsets = numpy.load(os.sep.join((store_dir, 'offsets.npy')), mmap_mode='r')
+        self.dates = numpy.load(os.sep.join((store_dir, 'dates.npy')), mmap_mode='r')
+        self.close = numpy.load(os.sep.join((store_dir, 'close.npy')), mmap_mode='r')
+        self.volume = numpy.load(os.sep.join((store_dir, 'volume.npy')), mmap_mode='r')
+        last_valid_path = os.sep.join((store_dir, 'last-valid.npy'))
+        if os.path.exists(last_valid_path):
+            self.last_valid = numpy.load(last_valid_path, mmap_mode='r')
+        else:
+            # store built before the rows of the last available closes were saved
+            self.last_valid = last_valid_rows(self.__offsets, self.close)
+
+    def codes(self):
+        return self.__codes
+
+    def version(self):
+        """
+        Changes whenever the store is rebuilt.
+        """
+        stats = [os.stat(os.sep.join((self.__store_dir, name))) for name in ('codes.txt', 'offsets.npy', 'dates.npy', 'close.npy')]
+        return tuple((int(stat.st_mtime), stat.st_size) for stat in stats)
+
+    def size(self):
+        return len(self.__codes)
+
+    def has_security(self, code):
+        return code in self.__index
+
+    def position(self, code):
+        return self.__index[code]
+
+    def bounds(self, code):
+        position = self.__index[code]
+        return int(self.__offsets[position]), int(self.__offsets[position + 1])
+
+    def owners(self):
+        """
+        Storage position of the security owning each row of the field blocks.
+        """
+        return numpy.repeat(numpy.arange(len(self.__codes)), numpy.diff(self.__offsets))
+
+    def series(self, code):
+        """
+        Returns (dates, close, volume) views for the security.
+        """
+        start, end = self.bounds(code)
+        return self.dates[start:end], self.close[start:end], self.volume[start:end]
+
+    def segments(self, codes):
+        """
+        Returns (starts, ends) arrays delimiting each of the securities.
+        """
+        positions = numpy.array([self.__index[code] for code in codes], dtype=numpy.int64)
+        return numpy.asarray(self.__offsets[positions]), numpy.asarray(self.__offsets[positions + 1])
+
+def search_segments(values, starts, ends, target):
+    """
+    Vectorized binary search over several sorted segments of values at once:
+    returns for each segment the index of the last value <= target, or
+    start - 1 when there is none. The target is either shared by all the
+    segments or given for each of them.
+    """
+    low = numpy.array(starts, dtype=numpy.int64)
+    high = numpy.array(ends, dtype=numpy.int64)
+    targets = numpy.broadcast_to(target, low.shape)
+    while True:
+        searching = low < high
+        if not searching.any():
+            break
+        middle = (low + high) // 2
+        before = numpy.zeros(len(low), dtype=bool)
+        before[searching] = values[middle[searching]] <= targets[searching]
+        low = numpy.where(searching & before, middle + 1, low)
+        high = numpy.where(searching & ~before, middle, high)
+    return low - 1
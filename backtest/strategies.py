@@ -0,0 +1,134 @@
+"""
+Strategies choose at each rebalance the weights of the portfolio from the
+screening of the period, positive weights being long and negative weights
+short positions. All the strategies see the same screening, so that several
+of them are backtested in lockstep over a single pass through the data.
+"""
+from risk import inverse_beta_weights
+from risk import minimum_variance_weights
+
+class Screen(object):
+    """
+    Screening of a rebalance: the lowest and highest volatility candidates,
+    with the volatility of every screened security and the risk estimates
+    over the screening window, if any.
+    """
+
+    def __init__(self, as_of_date, lowest, highest, volatilities, risk=None):
+        self.as_of_date = as_of_date
+        self.lowest = lowest
+        self.highest = highest
+        self.volatilities = volatilities
+        self.risk = risk
+
+    def leg(self, leg):
+        return self.lowest if leg == 'low' else self.highest
+
+def equal_weights(codes, total=1.0):
+    return dict((code, total / len(codes)) for code in codes)
+
+class Strategy(object):
+
+    name = None
+
+    def weights(self, screen):
+        """
+        Weight of each security to hold until the next rebalance.
+        """
+        raise NotImplementedError
+
+class LowVolatility(Strategy):
+
+    name = 'low-volatility'
+
+    def weights(self, screen):
+        return equal_weights(screen.lowest)
+
+class HighVolatility(Strategy):
+
+    name = 'high-volatility'
+
+    def weights(self, screen):
+        return equal_weights(screen.highest)
+
+class LongShort(Strategy):
+    """
+    Long the lowest and short the highest volatility candidates, each leg
+    being half of the gross exposure.
+    """
+
+    name = 'long-short'
+
+    def weights(self, screen):
+        weights = equal_weights(screen.lowest, 0.5)
+        for code, weight in equal_weights(screen.highest, -0.5).items():
+            weights[code] = weights.get(code, 0.0) + weight
+
+        # names in both legs cancel out
+        return dict((code, weight) for code, weight in weights.items() if weight != 0.0)
+
+class InverseVolatility(Strategy):
+    """
+    Candidates of one leg weighted by the inverse of their volatility.
+    """
+
+    def __init__(self, leg='low'):
+        self.leg = leg
+        self.name = 'inverse-volatility-%s' % leg
+
+    def weights(self, screen):
+        codes = screen.leg(self.leg)
+        inverses = dict((code, 1.0 / screen.volatilities[code]) for code in codes if screen.volatilities[code] > 0.0)
+        total = sum(inverses.values())
+        return dict((code, inverse / total) for code, inverse in inverses.items())
+
+class InverseBeta(Strategy):
+    """
+    Candidates of one leg weighted by the inverse of their beta against the
+    benchmark.
+    """
+
+    def __init__(self, leg='low'):
+        self.leg = leg
+        self.name = 'inverse-beta-%s' % leg
+
+    def weights(self, screen):
+        codes = screen.leg(self.leg)
+        weights = inverse_beta_weights(screen.risk.betas(codes))
+        return dict((code, weight) for code, weight in zip(codes, weights) if weight > 0.0)
+
+class MinimumVariance(Strategy):
+    """
+    Long only minimum variance portfolio of the candidates of one leg, over
+    their shrinkage covariance matrix.
+    """
+
+    def __init__(self, leg='low'):
+        self.leg = leg
+        self.name = 'minimum-variance-%s' % leg
+
+    def weights(self, screen):
+        codes = screen.leg(self.leg)
+        if len(codes) == 0:
+            return dict()
+
+        weights = minimum_variance_weights(screen.risk.covariance(codes))
+        return dict((code, weight) for code, weight in zip(codes, weights) if weight > 0.0)
+
+STRATEGIES = {
+    'low-volatility': LowVolatility,
+    'high-volatility': HighVolatility,
+    'long-short': LongShort,
+    'inverse-volatility-low': lambda: InverseVolatility('low'),
+    'inverse-volatility-high': lambda: InverseVolatility('high'),
+    'inverse-beta-low': lambda: InverseBeta('low'),
+    'inverse-beta-high': lambda: InverseBeta('high'),
+    'minimum-variance-low': lambda: MinimumVariance('low'),
+    'minimum-variance-high': lambda: MinimumVariance('high'),
+    }
+
+def create_strategy(name):
+    if name not in STRATEGIES:
+        raise ValueError('unknown strategy %s, expected one of %s' % (name, ', '.join(sorted(STRATEGIES.keys()))))
+
+    return STRATEGIES[name]()
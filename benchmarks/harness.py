@@ -0,0 +1,161 @@
+"""
+Times each stage of the pipeline over synthetic datasources and saves the
+timings as JSON, to track regressions in throughput and peak memory.
+
+    python -m benchmarks.harness [--securities N] [--years N] [--output path]
+
+Peak memory is the high-water mark of the resident set size reached so far,
+by the harness itself and by the largest of its worker processes.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import resource
+import argparse
+import tempfile
+from datetime import datetime
+
+from backtest import constants
+from backtest.store import build_price_store
+from backtest.ingest import build_stats
+from backtest.universe import Universe
+from backtest.screening import Screening
+from backtest.pricing import Pricing
+from benchmarks.synthetic import generate
+from btrun import load_equities
+from btrun import month_range
+from btrun import screening_months
+from btrun import run_backtest
+
+class Stages(object):
+    
+    def __init__(self):
+        self.results = list()
+        
+    def run(self, name, function, count=None, unit=None):
+        """
+        Runs the stage, recording its wall time, throughput and peak memory.
+        """
+        logging.info('running stage %s' % name)
+        start_time = time.time()
+        value = function()
+        elapsed = time.time() - start_time
+        stage = {
+            'name': name,
+            'seconds': elapsed,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_max_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            }
+        if count is not None:
+            stage['count'] = count
+            stage['throughput'] = count / max(elapsed, 1e-6)
+            stage['unit'] = '%s/s' % unit
+            
+        logging.info('stage %s done in %.2fs' % (name, elapsed))
+        self.results.append(stage)
+        return value
+        
+def price_lookups(pricer, codes, periods, count_lookups, count_codes):
+    random.seed(1)
+    for _ in xrange(count_lookups):
+        date_start, date_end = random.choice(periods)
+        pricer.get_prices(date_end, random.sample(codes, min(count_codes, len(codes))))
+        
+def run(count_securities, first_year, count_years, processes=None, count_lookups=1000):
+    """
+    Runs all the stages in the current directory, returning their timings.
+    """
+    stages = Stages()
+    count_rows = stages.run('synthetic data', lambda: generate(constants.DATASOURCE_DIR, count_securities, first_year, count_years))
+    for directory in (constants.CACHE_DIR, constants.RESULTS_DIR):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            
+    # adjusted prices are only read through the returns of the perfs store
+    stages.run('price store', lambda: build_price_store(constants.UNADJUSTED_PRICES_DATA, constants.UNADJUSTED_PRICES_STORE), count_rows, 'rows')
+    stages.run('perfs db', lambda: build_stats(perfs=True, volumes=False, processes=processes, incremental=False), count_rows, 'rows')
+    stages.run('volume stats', lambda: build_stats(perfs=False, volumes=True, processes=processes, incremental=False), count_rows, 'rows')
+    
+    # backtests start once enough history is available for screening
+    start_yyyymm = '%d01' % (first_year + 2)
+    count_periods = min(60, (count_years - 2) * 12)
+    count_months = 18
+    periods = list(month_range(start_yyyymm, count_periods, 1))
+    universe = stages.run('universe', lambda: Universe(load_equities()))
+    stages.run('universe snapshots', lambda: universe.load_snapshots(10e6))
+    screener = stages.run('screening init', lambda: Screening(universe))
+    
+    def screening():
+        screener.prepare(screening_months(periods), count_months=count_months)
+        for (date_start, date_end), yyyymm in zip(periods, screening_months(periods)):
+            universe.init_month(date_start.year, date_start.month, 10e6)
+            screener.compute_volatilities(yyyymm, count_months=count_months, count_securities=100)
+            
+    stages.run('screening', screening, count_periods, 'months')
+    pricer = stages.run('pricing init', Pricing)
+    codes = load_equities()
+    stages.run('pricing lookups', lambda: price_lookups(pricer, codes, periods, count_lookups, 100), count_lookups, 'lookups')
+    stages.run('backtest', lambda: run_backtest(universe, screener, Pricing(), start_yyyymm, count_periods, count_months), count_periods, 'periods')
+    return stages.results
+    
+def main():
+    parser = argparse.ArgumentParser(description='Times the backtest pipeline over synthetic data.')
+    parser.add_argument('--securities', type=int, default=200)
+    parser.add_argument('--first-year', type=int, default=2003)
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--work-dir', help='kept after the run, a temporary directory is used otherwise')
+    parser.add_argument('--output', default=os.sep.join((constants.RESULTS_DIR, 'benchmark-%s.json' % time.strftime('%Y%m%d-%H%M%S'))))
+    args = parser.parse_args()
+    # the backtest starts after two years of history used for the screening
+    if args.years < 3:
+        parser.error('--years must be at least 3, the first two only providing history')
+        
+    if args.securities < 1 or args.lookups < 0:
+        parser.error('--securities must be positive and --lookups not negative')
+        
+    
+    output = os.path.abspath(args.output)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='us-equities-bench-')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+        
+    started = datetime.now().isoformat()
+    current_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        stages = run(args.securities, args.first_year, args.years, args.processes, args.lookups)
+        
+    finally:
+        os.chdir(current_dir)
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+            
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+        
+    report = {
+        'started': started,
+        'python': sys.version.split()[0],
+        'parameters': {'securities': args.securities, 'first_year': args.first_year, 'years': args.years, 'processes': args.processes, 'lookups': args.lookups},
+        'stages': stages,
+        }
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+        
+    for stage in stages:
+        print('%-20s %8.2fs %10d kB' % (stage['name'], stage['seconds'], stage['max_rss_kb']))
+        
+    print('saved to %s' % output)
+    
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)s %(asctime)s %(module)s - %(message)s'
+    )
+    main()
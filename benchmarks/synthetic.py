@@ -0,0 +1,112 @@
+"""
+Synthetic datasources in the layout of the proprietary ones: price ZIPs with
+one output/<code>.txt member per security (date, open, high, low, close,
+volume, with #N/A gaps), dividends.csv, w5000.csv and us-equities.csv.
+
+Prices follow geometric random walks. Some securities are listed late or
+delisted early, and some split once, their unadjusted prices before the split
+being a multiple of the adjusted ones.
+"""
+import os
+import logging
+from datetime import date
+from datetime import timedelta
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+
+import numpy
+
+from backtest import constants
+
+MISSING_ROW = '%s,#N/A N/A,#N/A N/A,#N/A N/A,#N/A N/A,#N/A N/A'
+
+def business_days(first_year, count_years):
+    days = list()
+    day = date(first_year, 1, 1)
+    while day.year < first_year + count_years:
+        if day.weekday() < 5:
+            days.append(day)
+            
+        day += timedelta(days=1)
+        
+    return days
+    
+def security_rows(days, closes, volumes, missing):
+    """
+    Rows of a price member, spreading open, high and low around the close.
+    """
+    spreads = 1.0 + 0.01 * numpy.abs(numpy.random.standard_normal(len(closes)))
+    rows = list()
+    for day, close, spread, volume, gap in zip(days, closes, spreads, volumes, missing):
+        yyyy_mm_dd = day.isoformat()
+        if gap:
+            rows.append(MISSING_ROW % yyyy_mm_dd)
+            
+        else:
+            rows.append('%s,%.4f,%.4f,%.4f,%.4f,%d' % (yyyy_mm_dd, close * spread ** 0.5, close * spread, close / spread, close, volume))
+            
+    return '\n'.join(rows) + '\n'
+    
+def generate(datasource_dir, count_securities=200, first_year=2003, count_years=10, seed=1):
+    """
+    Writes the datasources, returning the number of price rows per ZIP.
+    """
+    numpy.random.seed(seed)
+    if not os.path.isdir(datasource_dir):
+        os.makedirs(datasource_dir)
+        
+    def target(source):
+        return os.sep.join((datasource_dir, os.path.basename(source)))
+        
+    days = business_days(first_year, count_years)
+    codes = ['S%05d' % index for index in xrange(count_securities)]
+    dividends = list()
+    count_rows = 0
+    adjusted_zip = ZipFile(target(constants.PRICES_DATA), 'w', ZIP_DEFLATED)
+    unadjusted_zip = ZipFile(target(constants.UNADJUSTED_PRICES_DATA), 'w', ZIP_DEFLATED)
+    try:
+        for index, code in enumerate(codes):
+            # one in seven securities is listed late, one in eleven delisted early
+            first = numpy.random.randint(0, len(days) // 2) if index % 7 == 0 else 0
+            last = len(days) - numpy.random.randint(0, len(days) // 4) if index % 11 == 0 else len(days)
+            count_days = last - first
+            volatility = 0.005 + 0.03 * numpy.random.random_sample()
+            closes = (5.0 + 95.0 * numpy.random.random_sample()) * numpy.exp(numpy.cumsum(numpy.random.normal(0.0, volatility, count_days)))
+            volumes = numpy.random.lognormal(12.0, 1.5, count_days).astype(numpy.int64)
+            volumes[numpy.random.random_sample(count_days) < 0.01] = 0
+            missing = numpy.random.random_sample(count_days) < 0.01
+            security_days = days[first:last]
+            adjusted_zip.writestr('output/%s.txt' % code, security_rows(security_days, closes, volumes, missing))
+            unadjusted_closes, unadjusted_volumes = closes.copy(), volumes.copy()
+            if index % 5 == 0 and count_days > 2:
+                split = numpy.random.randint(1, count_days - 1)
+                unadjusted_closes[:split] *= 2.0
+                unadjusted_volumes[:split] //= 2
+                
+            unadjusted_zip.writestr('output/%s.txt' % code, security_rows(security_days, unadjusted_closes, unadjusted_volumes, missing))
+            count_rows += count_days
+            if index % 2 == 0:
+                for day_index in xrange(30, count_days, 63):
+                    dividends.append('%s,%s,%.4f' % (code, security_days[day_index].strftime('%Y%m%d'), closes[day_index] * 0.005))
+                    
+            if (index + 1) % 100 == 0:
+                logging.info('generated %d/%d securities' % (index + 1, count_securities))
+                
+    finally:
+        adjusted_zip.close()
+        unadjusted_zip.close()
+        
+    with open(target(constants.SOURCE_DIVIDENDS), 'w') as dividends_file:
+        dividends_file.write('\n'.join(dividends) + '\n')
+        
+    levels = 1000.0 * numpy.exp(numpy.cumsum(numpy.random.normal(0.0, 0.01, len(days))))
+    with open(target(constants.SOURCE_BENCHMARK), 'w') as benchmark_file:
+        for day, level in zip(days, levels):
+            benchmark_file.write('%s,%.2f\n' % (day.isoformat(), level))
+            
+    with open(target(constants.SOURCE_US_EQUITIES), 'w') as equities_file:
+        equities_file.write('code,name\n')
+        for code in codes:
+            equities_file.write('%s,Synthetic %s\n' % (code, code))
+            
+    return count_rows
@@ -4,10 +4,27 @@ import logging
 from datetime import datetime
 from datetime import timedelta
 import calendar
+from collections import OrderedDict
+
+import numpy
 
 from backtest.universe import Universe
 from backtest.screening import Screening
 from backtest.pricing import Pricing
+from backtest.accounting import Holdings
+from backtest.strategies import Screen
+from backtest.strategies import HighVolatility
+from backtest.strategies import LowVolatility
+from backtest.strategies import create_strategy
+from backtest.risk import RiskModel
+from backtest import accounting
+from backtest.store import day_number
+from backtest.store import from_day_number
+from backtest.instrumentation import Instrumentation
+from backtest.instrumentation import NullInstrumentation
+from backtest.instrumentation import profiling
+from backtest.results import ResultsStore
+from backtest.results import RunRecorder
 from backtest import constants
 
 def month_range(start_yyyymm, count=10, step=3):
@@ -25,8 +42,17 @@ def month_range(start_yyyymm, count=10, step=3):
         next_range = (first_date, second_date)
         yield next_range
         
+def screening_months(periods):
+    """
+    Volatilities are computed up to the month preceding each period.
+    """
+    return [(date_start - timedelta(days=1)).strftime('%Y%m') for date_start, date_end in periods]
+    
 def normalized(percents):
-    total = float(sum(percents.values()))
+    """
+    Weights scaled to a gross exposure of 1, short weights being negative.
+    """
+    total = float(sum(abs(percent) for percent in percents.values()))
     final = dict()
     for code in percents.keys():
         final[code] = float(percents[code]) / total
@@ -38,156 +64,338 @@ def apply_strategy(pricer, percents, amount, as_of_date):
         Buy/Sell at close price.
         """
         weights = normalized(percents)
-        portfolio = dict()
-        final_amount = amount
-        for code in weights.keys():
-            position = weights[code] * amount
-            #
-            # buying / selling shares
-            #
-            price = pricer.get_price(as_of_date, code)
-            shares = position / price
-            portfolio[code] = int(round(shares))
-            final_amount -= float(portfolio[code]) * price
+        codes = weights.keys()
+        prices = pricer.get_prices(as_of_date, codes)
+        if numpy.isnan(prices).any():
+            raise ValueError('no price available as of %s for %s' % (as_of_date.strftime('%Y-%m-%d'), [code for code, price in zip(codes, prices) if numpy.isnan(price)]))
             
+        #
+        # buying / selling shares, rounded half away from zero
+        #
+        shares = numpy.array([weights[code] for code in codes]) * amount / prices
+        shares = numpy.sign(shares) * numpy.floor(numpy.abs(shares) + 0.5)
+        portfolio = Holdings(pricer.security_ids(codes), shares)
+        final_amount = amount - float(numpy.dot(shares, prices))
         return portfolio, final_amount
     
-def create_portfolio(pricer, amount, securities, as_of_date):
+def create_portfolio(pricer, amount, weightings, as_of_date):
     logging.info('creating portfolio as of %s' % as_of_date.strftime('%Y-%m-%d'))
-    weightings = dict()
-    for security in securities:
-        # assumes equal weighting
-        # TODO: adjust weighting according to individual beta
-        weightings[security] = 1.0 / len(securities)
-    
+    if len(weightings) == 0:
+        return Holdings.empty(), amount
+        
     portfolio, residual_cash = apply_strategy(pricer, weightings, amount, as_of_date)
     return portfolio, residual_cash
    
 class Backtest(object):
     
-    def __init__(self):
-        self.__pricer = Pricing() 
+    def __init__(self, pricer=None):
+        self.__pricer = pricer or Pricing() 
     
     def run_period(self, date_start, date_end, portfolio, residual_cash):
-        dividends = dict()
-        for code in portfolio.keys():
-            dividends[code] = self.__pricer.get_dividends(date_start, date_end, code) * float(portfolio[code])
-        
-        residual_cash += sum(dividends.values())
+        codes = self.__pricer.security_codes(portfolio.ids)
+        dividends = self.__pricer.get_portfolio_dividends(date_start, date_end, codes) * portfolio.shares
+        residual_cash += dividends.sum()
         
         return residual_cash
 
+    def prices(self, as_of_date, ids):
+        """
+        Close prices as of the date, aligned on the security ids.
+        """
+        return self.__pricer.get_prices(as_of_date, self.__pricer.security_codes(ids))
+        
     def turn_shares_into_amounts(self, portfolio, as_of_date, normalized=False):
         """
-        Using as_of_date close price.
+        Using as_of_date close price, aligned on the portfolio ids.
         """
-        amounts = dict()
-        total = 0.0
-        for code in portfolio.keys():
-            price = self.__pricer.get_price(as_of_date, code)
-            amount = portfolio[code] * price
-            amounts[code] = amount
-            total += amount
-            
+        amounts = portfolio.amounts(self.prices(as_of_date, portfolio.ids))
         if normalized:
-            for code in amounts.keys():
-                amounts[code] /= total
+            amounts /= amounts.sum()
         
         return amounts
     
     def delta_additions(self, portfolio, prev_portfolio):
-        codes = set(portfolio.keys())
-        prev_codes = set(prev_portfolio.keys())
-        added_codes = codes - prev_codes
-        additions = [(code, portfolio[code]) for code in added_codes]
-        return additions
+        ids, added, dropped, adjusted, traded = portfolio.deltas(prev_portfolio)
+        return zip(self.__pricer.security_codes(ids[added]), traded[added])
     
     def delta_deletions(self, portfolio, prev_portfolio):
-        codes = set(portfolio.keys())
-        prev_codes = set(prev_portfolio.keys())
-        dropped_codes = prev_codes - codes
-        deletions = [(code, prev_portfolio[code]) for code in dropped_codes]
-        return deletions
+        ids, added, dropped, adjusted, traded = portfolio.deltas(prev_portfolio)
+        return zip(self.__pricer.security_codes(ids[dropped]), -traded[dropped])
     
     def delta_adjustments(self, portfolio, prev_portfolio):
-        codes = set(portfolio.keys())
-        prev_codes = set(prev_portfolio.keys())
-        adjusted_codes = codes & prev_codes
-        adjustments = [(code, portfolio[code] - prev_portfolio[code]) for code in adjusted_codes]
-        return adjustments
+        ids, added, dropped, adjusted, traded = portfolio.deltas(prev_portfolio)
+        return zip(self.__pricer.security_codes(ids[adjusted]), traded[adjusted])
     
     def turnover(self, date, portfolio, prev_portfolio):
-        prev_amounts = self.turn_shares_into_amounts(prev_portfolio, date)
-        amounts = self.turn_shares_into_amounts(portfolio, date)
-        dropped_amount = 0.0
-        for code in dropped_codes:
-            logging.debug('liquidation of %s: %.0f' % (code, prev_amounts[code]))
-            dropped_amount += prev_amounts[code]
-            
-        added_amount = 0.0
-        for code in added_codes:
-            logging.debug('new investment in %s: %.0f' % (code, amounts[code]))
-            added_amount += amounts[code]
-            
-        adjusted_amount = 0.0
-        for code in adjusted_codes:
-            adjustment = amounts[code] - prev_amounts[code]
-            logging.debug('adjustment for %s: %.0f' % (code, adjustment))
-            adjusted_amount += adjustment
-            
-        return (dropped_amount, added_amount, adjusted_amount)
+        """
+        Returns (liquidated, newly invested, adjusted) amounts at date close.
+        """
+        ids, shares, prev_shares = portfolio.aligned(prev_portfolio)
+        return accounting.turnover(shares, prev_shares, self.prices(date, ids))
+        
+    def transaction_costs(self, date, portfolio, prev_portfolio, cost_rate, cost_per_share=0.0):
+        ids, shares, prev_shares = portfolio.aligned(prev_portfolio)
+        return accounting.transaction_costs(shares, prev_shares, self.prices(date, ids), cost_rate, cost_per_share)
 
+    def daily_valuations(self, date_start, date_end, portfolio, cash):
+        """
+        Returns (days, navs): the portfolio marked to market on the first day
+        of the period, on every trading day and on the last day, dividends
+        being added to cash on their ex-dates.
+        """
+        codes = self.__pricer.security_codes(portfolio.ids)
+        days, prices = self.__pricer.get_daily_prices((date_start, date_end), codes)
+        day_end = day_number(date_end)
+        if days[-1] < day_end:
+            days = numpy.append(days, day_end)
+            prices = numpy.vstack((prices, prices[-1]))
+            
+        dividends = self.__pricer.get_running_dividends(date_start, days, codes)
+        return days, (prices + dividends).dot(portfolio.shares) + cash
+        
     def valuation(self, date, portfolio, cash):
-        return sum( self.turn_shares_into_amounts(portfolio, date).values() ) + cash
+        return portfolio.valuation(self.prices(date, portfolio.ids)) + cash
         
     def positions(self, date, portfolio):
-        return self.turn_shares_into_amounts(portfolio, date)
+        return dict(zip(self.__pricer.security_codes(portfolio.ids), self.turn_shares_into_amounts(portfolio, date)))
         
     def get_benchmark_performance(self, start_date, end_date):
         price_start = self.__pricer.get_benchmark_level(start_date)
         price_end = self.__pricer.get_benchmark_level(end_date)
         return price_end / price_start - 1.0
 
-def main():
+def load_equities():
     with open(constants.SOURCE_US_EQUITIES, 'r') as equities_file:
-        equities = [row.split(',')[0] for row in map(str.strip, equities_file.readlines())[1:]]
-        
-    universe = Universe(equities)
-    screener = Screening(universe)
-    pricer = Pricing() 
-    bt = Backtest()
-    portfolios = dict()
-    prev_portfolio = dict()
-    cash = 1e6
-    amount_invested = cash # initial investment
-    
-    for date_start, date_end in month_range('200601', 60, 1):
-        logging.info('creating portfolio as of %s' % (date_start.strftime('%Y-%m-%d')))
-        universe.init_month(date_start.year, date_start.month, 10e6)
-        logging.info('universe size: %d' % universe.size())
-        
-        hist_data_range = date_start - timedelta(days=1)
-        (buy_list, sell_list) = screener.compute_volatilities(hist_data_range.strftime('%Y%m'), count_months=18, count_securities=100)
-        
-        logging.info('investing %.0f as of %s' % (amount_invested, date_start.strftime('%Y-%m-%d')))
-        portfolio, residual_cash = create_portfolio(pricer, amount_invested, sell_list, date_start)
-        logging.debug('additions %s' % bt.delta_additions(portfolio, prev_portfolio))
-        logging.debug('deletions %s' % bt.delta_deletions(portfolio, prev_portfolio))
-        logging.debug('adjustments %s' % bt.delta_adjustments(portfolio, prev_portfolio))
-        # records positions
-        portfolios[date_start] = (portfolio, residual_cash)
+        return [row.split(',')[0] for row in map(str.strip, equities_file.readlines())[1:]]
+        
+def screen_securities(universe, screener, date_start, count_months, count_securities, min_dollar_volume, risk=None, instruments=None):
+    instruments = instruments or NullInstrumentation()
+    logging.info('creating portfolio as of %s' % (date_start.strftime('%Y-%m-%d')))
+    with instruments.stage('universe'):
+        universe.init_month(date_start.year, date_start.month, min_dollar_volume)
+        
+    logging.info('universe size: %d' % universe.size())
+    
+    hist_data_range = date_start - timedelta(days=1)
+    with instruments.stage('screening'):
+        (buy_list, sell_list, volatilities) = screener.screen(hist_data_range.strftime('%Y%m'), count_months=count_months, count_securities=count_securities)
+        
+    return Screen(date_start, buy_list, sell_list, volatilities, risk.window(hist_data_range.strftime('%Y%m'), count_months) if risk else None)
+    
+class StrategyRun(object):
+    """
+    Portfolio, cash and results of a strategy being backtested.
+    """
+    
+    def __init__(self, strategy, amount):
+        self.strategy = strategy
+        self.amount_invested = amount
+        self.weights = dict()
+        self.portfolio = Holdings.empty()
+        self.residual_cash = amount
+        self.results = list()
+        self.curve_days = list()
+        self.curve_navs = list()
+        
+def run_strategies(universe, screener, pricer, strategies, start_yyyymm='200601', count_periods=60, count_months=18,
+        count_securities=100, min_dollar_volume=10e6, cost_rate=0.0, daily=False, instruments=None, recorder=None):
+    """
+    Backtests the strategies in lockstep: the universe, the screening and the
+    prices of every period are computed once and shared by all of them.
+    
+    Returns by strategy name (date_start, date_end, valuation, performance,
+    benchmark performance) for each period.
+    
+    Transaction costs of cost_rate times the traded amount are paid out of
+    the residual cash at each rebalance.
+    
+    In daily mode (results, curve) is returned by strategy name, curve being
+    the (days, navs, benchmark levels) arrays of the daily mark-to-market
+    over all periods.
+    
+    Stages of every period are timed with the instruments, if any, and the
+    periods, holdings, trades and timings are kept by the recorder, if any,
+    for saving to the results store.
+    """
+    bt = Backtest(pricer)
+    instruments = instruments or NullInstrumentation()
+    if recorder is not None:
+        recorder.parameters.update(start_yyyymm=start_yyyymm, count_periods=count_periods, count_months=count_months,
+            count_securities=count_securities, min_dollar_volume=min_dollar_volume, cost_rate=cost_rate)
+        
+    runs = [StrategyRun(strategy, 1e6) for strategy in strategies] # initial investment
+    instruments.sample_cache('price cache', *pricer.cache_stats()[:2])
+    instruments.sample_cache('screening cache', *screener.cache_stats())
+    periods = list(month_range(start_yyyymm, count_periods, 1))
+    with instruments.stage('screening'):
+        screener.prepare(screening_months(periods), count_months=count_months, min_dollar_volume=min_dollar_volume)
+        
+    risk = RiskModel(screener.returns_matrix, pricer.benchmark)
+    selection = dict(count_months=count_months, count_securities=count_securities, min_dollar_volume=min_dollar_volume, risk=risk, instruments=instruments)
+    
+    def allocate(date_start):
+        """
+        Sets the weights of every strategy, returning all the codes held.
+        """
+        screen = screen_securities(universe, screener, date_start, **selection)
+        with instruments.stage('weighting'):
+            for run in runs:
+                run.weights = run.strategy.weights(screen)
+            
+        return sorted(set(code for run in runs for code in run.weights))
+        
+    if periods:
+        securities = allocate(periods[0][0])
+        with instruments.stage('pricing'):
+            pricer.load_block(securities, periods[0])
+        
+    for index, (date_start, date_end) in enumerate(periods):
+        instruments.start_period(date_start.strftime('%Y-%m'))
+        for run in runs:
+            logging.info('%s: investing %.0f as of %s' % (run.strategy.name, run.amount_invested, date_start.strftime('%Y-%m-%d')))
+            prev_portfolio = run.portfolio
+            with instruments.stage('pricing'):
+                run.portfolio, run.residual_cash = create_portfolio(pricer, run.amount_invested, run.weights, date_start)
+                
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('additions %s' % bt.delta_additions(run.portfolio, prev_portfolio))
+                logging.debug('deletions %s' % bt.delta_deletions(run.portfolio, prev_portfolio))
+                logging.debug('adjustments %s' % bt.delta_adjustments(run.portfolio, prev_portfolio))
+                
+            with instruments.stage('turnover'):
+                logging.info('turnover (liquidated, invested, adjusted): %.0f, %.0f, %.0f' % bt.turnover(date_start, run.portfolio, prev_portfolio))
+                if cost_rate:
+                    run.residual_cash -= bt.transaction_costs(date_start, run.portfolio, prev_portfolio, cost_rate)
+                    
+            if recorder is not None:
+                with instruments.stage('recording'):
+                    ids, shares, prev_shares = run.portfolio.aligned(prev_portfolio)
+                    recorder.add_positions(run.strategy.name, date_start, pricer.security_codes(ids), shares, bt.prices(date_start, ids), shares - prev_shares)
+                    
+        if index + 1 < len(periods):
+            # next candidates prices are loaded while the current period is valued
+            securities = allocate(periods[index + 1][0])
+            pricer.preload(securities, periods[index + 1])
             
         logging.info('back testing over period %s through %s' % (date_start.strftime('%Y-%m-%d'), date_end.strftime('%Y-%m-%d')))
-        final_cash = bt.run_period(date_start, date_end, portfolio, residual_cash)
-        amount_final = bt.valuation(date_end, portfolio, final_cash)
-        logging.info('valuation as of %s: %.0f' % (date_end.strftime('%Y-%m-%d'), amount_final))
-        logging.debug('positions at start of period: %s' % (bt.turn_shares_into_amounts(portfolio, date_start)))
-        logging.debug('positions at end of period: %s' % (bt.turn_shares_into_amounts(portfolio, date_end)))
-        logging.info('performance / benchmark: %.2f%% / %.2f%%' % ((amount_final / amount_invested - 1.0) * 100.0, bt.get_benchmark_performance(date_start, date_end)  * 100.0))
-        amount_invested = amount_final
-        prev_portfolio = portfolio
+        with instruments.stage('benchmark'):
+            benchmark_performance = bt.get_benchmark_performance(date_start, date_end)
+            
+        for run in runs:
+            with instruments.stage('dividends'):
+                final_cash = bt.run_period(date_start, date_end, run.portfolio, run.residual_cash)
+                
+            with instruments.stage('valuation'):
+                amount_final = bt.valuation(date_end, run.portfolio, final_cash)
+                
+            if daily:
+                with instruments.stage('daily valuation'):
+                    days, navs = bt.daily_valuations(date_start, date_end, run.portfolio, run.residual_cash)
+                    
+                # a period starting on the last day of the previous one would repeat it
+                overlap = 1 if run.curve_days and run.curve_days[-1][-1] == days[0] else 0
+                run.curve_days.append(days[overlap:])
+                run.curve_navs.append(navs[overlap:])
+                
+            logging.info('%s: valuation as of %s: %.0f' % (run.strategy.name, date_end.strftime('%Y-%m-%d'), amount_final))
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('positions at start of period: %s' % (bt.positions(date_start, run.portfolio)))
+                logging.debug('positions at end of period: %s' % (bt.positions(date_end, run.portfolio)))
+                
+            performance = amount_final / run.amount_invested - 1.0
+            logging.info('%s: performance / benchmark: %.2f%% / %.2f%%' % (run.strategy.name, performance * 100.0, benchmark_performance * 100.0))
+            run.results.append((date_start, date_end, amount_final, performance, benchmark_performance))
+            if recorder is not None:
+                recorder.add_period(run.strategy.name, date_start, date_end, run.residual_cash, final_cash, amount_final, performance, benchmark_performance)
+                
+            run.amount_invested = amount_final
+            
+        instruments.sample_cache('price cache', *pricer.cache_stats()[:2])
+        instruments.sample_cache('screening cache', *screener.cache_stats())
             
     logging.info('finished backtesting')
+    logging.info('price cache hits / misses: %d / %d, %d bytes' % pricer.cache_stats())
+    if recorder is not None:
+        recorder.add_timings(instruments)
+        recorder.finish()
+        
+    outcomes = OrderedDict()
+    for run in runs:
+        outcomes[run.strategy.name] = run.results
+        if daily:
+            days = numpy.concatenate(run.curve_days) if run.curve_days else numpy.zeros(0, dtype=numpy.int32)
+            navs = numpy.concatenate(run.curve_navs) if run.curve_navs else numpy.zeros(0)
+            outcomes[run.strategy.name] = (run.results, (days, navs, pricer.get_benchmark_levels(days)))
+            
+    return outcomes
+    
+def run_backtest(universe, screener, pricer, start_yyyymm='200601', count_periods=60, count_months=18,
+        count_securities=100, min_dollar_volume=10e6, volatility_leg='high', cost_rate=0.0, daily=False,
+        instruments=None, recorder=None):
+    """
+    Invests every period in the lowest or highest volatility securities of
+    the liquid universe, see run_strategies.
+    """
+    strategy = HighVolatility() if volatility_leg == 'high' else LowVolatility()
+    outcomes = run_strategies(universe, screener, pricer, [strategy], start_yyyymm, count_periods, count_months,
+        count_securities, min_dollar_volume, cost_rate, daily, instruments, recorder)
+    return outcomes[strategy.name]
+    
+def save_equity_curve(curve, curve_path=constants.EQUITY_CURVE):
+    """
+    Writes the daily NAV, the benchmark rebased to the initial NAV and the
+    drawdowns as CSV.
+    """
+    days, navs, benchmark_levels = curve
+    benchmark = benchmark_levels / benchmark_levels[0] * navs[0]
+    with open(curve_path, 'w') as curve_file:
+        curve_file.write('date,nav,benchmark,drawdown,benchmark_drawdown' + os.linesep)
+        for day, nav, level, drawdown, benchmark_drawdown in zip(days, navs, benchmark, accounting.drawdowns(navs), accounting.drawdowns(benchmark)):
+            curve_file.write('%s,%.2f,%.2f,%.6f,%.6f' % (from_day_number(day).strftime('%Y-%m-%d'), nav, level, drawdown, benchmark_drawdown) + os.linesep)
+            
+    logging.info('max drawdown / benchmark: %.2f%% / %.2f%%' % (accounting.drawdowns(navs).min() * 100.0, accounting.drawdowns(benchmark).min() * 100.0))
+    
+def main():
+    # --strategies=name,... backtests the strategies in lockstep, high-volatility by default
+    # --daily also marks the portfolios to market daily and saves their equity curves
+    # --profile saves cProfile stats, --trace-memory logs the largest allocations (python 3)
+    options = sys.argv[1:]
+    names = [option.split('=', 1)[1] for option in options if option.startswith('--strategies=')]
+    strategies = [create_strategy(name) for name in (names[-1].split(',') if names else ['high-volatility'])]
+    if not os.path.isdir(constants.RESULTS_DIR):
+        os.makedirs(constants.RESULTS_DIR)
+        
+    instruments = Instrumentation()
+    recorder = RunRecorder()
+    with profiling(constants.RUN_PROFILE if '--profile' in options else None, trace_memory='--trace-memory' in options):
+        with instruments.stage('universe'):
+            universe = Universe(load_equities())
+            
+        with instruments.stage('screening'):
+            screener = Screening(universe)
+            
+        with instruments.stage('pricing'):
+            pricer = Pricing() 
+            
+        outcomes = run_strategies(universe, screener, pricer, strategies, daily='--daily' in options, instruments=instruments, recorder=recorder)
+        
+    for name, results in outcomes.items():
+        if '--daily' in options:
+            results, curve = results
+            curve_path = constants.EQUITY_CURVE if len(outcomes) == 1 else '-'.join((os.path.splitext(constants.EQUITY_CURVE)[0], name)) + '.csv'
+            save_equity_curve(curve, curve_path)
+            
+        amount_final = results[-1][2] if results else 1e6
+        logging.info('%s: total performance %.2f%%' % (name, (amount_final / 1e6 - 1.0) * 100.0))
+        
+    store = ResultsStore()
+    for run_id in store.save(recorder):
+        logging.info('saved run %s to %s' % (run_id, constants.RESULTS_DB))
+        
+    store.close()
+    instruments.save(constants.RUN_REPORT)
+    for line in instruments.summary():
+        logging.info(line)
     
 if __name__ == '__main__':
     # goal is to generate an output of portfolio performances
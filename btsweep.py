@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import logging
+import itertools
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+
+from backtest.universe import Universe
+from backtest.screening import Screening
+from backtest.pricing import Pricing
+from backtest.instrumentation import Instrumentation
+from backtest.results import ResultsStore
+from backtest.results import RunRecorder
+from backtest import constants
+from btrun import load_equities
+from btrun import month_range
+from btrun import run_backtest
+from btrun import screening_months
+
+PARAMETERS = ('start_yyyymm', 'count_periods', 'count_months', 'count_securities', 'min_dollar_volume', 'volatility_leg')
+
+DEFAULT_GRID = {
+    'start_yyyymm': ['200601'],
+    'count_periods': [60],
+    'count_months': [18],
+    'count_securities': [100],
+    'min_dollar_volume': [10e6],
+    'volatility_leg': ['high'],
+    }
+
+# read-only data loaded once by the parent and shared with the forked workers
+_shared = dict()
+
+def load_shared_data(grid):
+    universe = Universe(load_equities())
+    screener = Screening(universe)
+    for min_dollar_volume in grid['min_dollar_volume']:
+        universe.load_snapshots(min_dollar_volume)
+        
+    for start_yyyymm, count_periods, count_months, min_dollar_volume in itertools.product(grid['start_yyyymm'], grid['count_periods'], grid['count_months'], grid['min_dollar_volume']):
+        screener.prepare(screening_months(month_range(start_yyyymm, count_periods, 1)), count_months, min_dollar_volume)
+        
+    _shared['universe'] = universe
+    _shared['screener'] = screener
+    _shared['pricer'] = Pricing()
+    _shared['pricer'].load()
+    
+def configurations(grid):
+    values = [grid.get(name, DEFAULT_GRID[name]) for name in PARAMETERS]
+    return [dict(zip(PARAMETERS, combination)) for combination in itertools.product(*values)]
+    
+def run_configuration(params):
+    """
+    Backtests the configuration, returning the rows recorded for the parent
+    process to save.
+    """
+    recorder = RunRecorder(dict(volatility_leg=params['volatility_leg']))
+    run_backtest(_shared['universe'], _shared['screener'], _shared['pricer'], instruments=Instrumentation(), recorder=recorder, **params)
+    return params, recorder
+    
+def main(grid, processes=None):
+    if not os.path.isdir(constants.RESULTS_DIR):
+        os.makedirs(constants.RESULTS_DIR)
+        
+    load_shared_data(dict((name, grid.get(name, DEFAULT_GRID[name])) for name in PARAMETERS))
+    configs = configurations(grid)
+    sweep_id = time.strftime('%Y%m%d-%H%M%S')
+    logging.info('sweep %s: running %d configurations' % (sweep_id, len(configs)))
+    store = ResultsStore()
+    pool = Pool(processes=processes or cpu_count())
+    try:
+        # workers only compute, the parent is the single writer of the results store
+        for index, (params, recorder) in enumerate(pool.imap_unordered(run_configuration, configs)):
+            recorder.parameters['sweep_id'] = sweep_id
+            store.save(recorder)
+            logging.info('configuration %d/%d done in %.1fs: %s' % (index + 1, len(configs), recorder.elapsed, params))
+            
+        for run in store.runs(sweep_id=sweep_id):
+            logging.info('%s: total return / benchmark: %.2f%% / %.2f%%' % (run['run_id'], run['total_return'] * 100.0, run['benchmark_return'] * 100.0))
+            
+    finally:
+        pool.close()
+        pool.join()
+        store.close()
+        
+if __name__ == '__main__':
+    # usage: btsweep.py [grid.json], the grid mapping parameter names to lists of values
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)s %(asctime)s %(module)s - %(message)s',
+        filename=sys.argv[0].split('.')[0]  + '.log', filemode='w'
+    )
+    grid = dict()
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as grid_file:
+            grid = json.load(grid_file)
+            
+    main(grid)
+    
\ No newline at end of file
@@ -0,0 +1,14 @@
+import logging
+
+from backtest import constants
+from backtest.store import build_price_store
+
+def main():
+    build_price_store(constants.UNADJUSTED_PRICES_DATA, constants.UNADJUSTED_PRICES_STORE)
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(levelname)s %(asctime)s %(module)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,18 @@
+import sys
+import logging
+
+from backtest.snapshots import UniverseSnapshots
+from backtest.snapshots import snapshots_path
+from btrun import load_equities
+
+def main():
+    # usage: create-universe-snapshots.py [min_dollar_volume ...], defaults to 10e6
+    for min_dollar_volume in map(float, sys.argv[1:] or ['10e6']):
+        UniverseSnapshots.build(load_equities(), min_dollar_volume).save(snapshots_path(min_dollar_volume))
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(levelname)s %(asctime)s %(module)s - %(message)s'
+    )
+    main()